@@ -2,6 +2,7 @@ import skrf as rf
 from skrf.data import ring_slot
 from skrf.plotting import save_all_figs
 from scipy.optimize import minimize
+from scipy.stats import qmc
 import numpy as np
 import matplotlib.pyplot as plt
 from enum import Enum
@@ -9,6 +10,12 @@ from itertools import islice, product, zip_longest, combinations, repeat
 import math
 from multiprocessing import Pool
 import time
+import os
+import sys
+TEST_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'test')
+sys.path.append(TEST_DIR)
+from bands import BandSpec
+import matchingsim
 
 class CompKey(Enum):
     SERIES = 1
@@ -20,6 +27,12 @@ class CompType(Enum):
 
 
 Z_0 = 50
+HYBRID = False # continuous optimization, then the discrete sweep over the nearest real parts (see hybrid())
+HYBRID_K = 3 # real parts per optimized value
+MULTISTART = 16 # local optimizations per topology
+SEED_RANGE = (0.1, 100) # starting values are drawn log-uniformly from this range (pF / nH)
+DEDUP_TOLERANCE = 0.1 # optima closer than ~10% in every value are the same solution
+HYBRID_OPTIMA = 10 # best distinct continuous optima the hybrid mode searches around
 antenna = rf.Network('test/antenna/ellio-raw-22nH-shunt.s1p')
 lte = rf.Network('test/bp_LTE.s1p')
 
@@ -29,14 +42,19 @@ frequency = antenna.frequency
 line = rf.DefinedGammaZ0(frequency=frequency, z0=Z_0)
 # load Network
 
+# compiled once, the objectives only index the raw s11 arrays
+bands = BandSpec(['791mhz-861mhz', '1710mhz-1880mhz'], frequency)
+
 Nfeval = 1
 
 class Component:
-    def __init__(self, netfun, initial_value, bounds, factor):
+    def __init__(self, netfun, initial_value, bounds, factor, type, key):
         self.netfun = netfun
         self.initial_value = initial_value
         self.bounds = bounds
         self.factor = factor
+        self.type = type # CompType
+        self.key = key # CompKey
 
 def parse_network_template_description(network_description):
     cap_bounds = (1e-12, 10e3)
@@ -44,10 +62,10 @@ def parse_network_template_description(network_description):
     ind_bounds = (1e-12, 10e3)
     cap_initial = 1.5
     ind_initial = 1
-    series_cap = Component(line.capacitor, cap_initial, cap_bounds, 1e-12)
-    series_ind = Component(line.inductor, ind_initial, ind_bounds, 1e-9)
-    shunt_cap  = Component(line.shunt_capacitor, cap_initial, cap_bounds_shunt, 1e-12)
-    shunt_ind  = Component(line.shunt_inductor, ind_initial, ind_bounds, 1e-9)
+    series_cap = Component(line.capacitor, cap_initial, cap_bounds, 1e-12, CompType.CAPACITOR, CompKey.SERIES)
+    series_ind = Component(line.inductor, ind_initial, ind_bounds, 1e-9, CompType.INDUCTOR, CompKey.SERIES)
+    shunt_cap  = Component(line.shunt_capacitor, cap_initial, cap_bounds_shunt, 1e-12, CompType.CAPACITOR, CompKey.SHUNT)
+    shunt_ind  = Component(line.shunt_inductor, ind_initial, ind_bounds, 1e-9, CompType.INDUCTOR, CompKey.SHUNT)
     series_components = [series_cap, series_ind]
     shunt_components = [shunt_cap, shunt_ind]
     result = []
@@ -113,10 +131,7 @@ def get_bounds(variation):
 def objective_function(matching_net):
     def obj_fun(*args):
         _ntw = matching_net(*args)
-        range1 = '791mhz-861mhz'
-        range2 = '1710mhz-1880mhz'
-        max_db_1 = max(rf.mathFunctions.complex_2_db(_ntw[range1].s11.s))[0][0]
-        max_db_2 = max(rf.mathFunctions.complex_2_db(_ntw[range2].s11.s))[0][0]
+        (max_db_1, max_db_2) = bands.metrics(_ntw.s[:, 0, 0], ['max_db'])
         return -1 * max_db_1 * max_db_2
     return obj_fun
 
@@ -131,10 +146,7 @@ def objective_function_2(variation):
             i += 1
         _ntw = net ** antenna
 
-        range1 = '791mhz-861mhz'
-        range2 = '1710mhz-1880mhz'
-        max_db_1 = max(rf.mathFunctions.complex_2_db(_ntw[range1].s11.s))[0][0]
-        max_db_2 = max(rf.mathFunctions.complex_2_db(_ntw[range2].s11.s))[0][0]
+        (max_db_1, max_db_2) = bands.metrics(_ntw.s[:, 0, 0], ['max_db'])
         return -1 * max_db_1 * max_db_2
 
     return obj_fun
@@ -150,49 +162,193 @@ def objective_function_3(variation):
             i += 1
         _ntw = net ** antenna
 
-        range1 = '791mhz-861mhz'
-        range2 = '1710mhz-1880mhz'
-        max_db_1 = max(rf.mathFunctions.complex_2_db(_ntw[range1].s11.s))[0][0]
-        max_db_2 = max(rf.mathFunctions.complex_2_db(_ntw[range2].s11.s))[0][0]
-        min_db_1 = min(rf.mathFunctions.complex_2_db(_ntw[range1].s11.s))[0][0]
-        min_db_2 = min(rf.mathFunctions.complex_2_db(_ntw[range2].s11.s))[0][0]
+        (max_db_1, min_db_1, max_db_2, min_db_2) = bands.metrics(_ntw.s[:, 0, 0], ['max_db', 'min_db'])
 
         return max_db_2 + max_db_1
 
     return obj_fun_loc
 
 
-def sim_thread(variation):
-    matching_net = matching_network(variation)
-    x0 = get_starting_values(variation)
-    bound = get_bounds(variation)
-    res1 = minimize(objective_function_3(variation), x0, bounds=bound)#, callback = printx)
-    ntw1 = matching_net(*res1.x)
-    print(ntw1)
-    print('------------')
-    for comp in variation:
-        print(comp.netfun)
-    print(res1.x)
-    print('------------')
-    ntw1.plot_s_db(lw=2)
-    return res1
+# numpy version of objective_function_3 for ideal lumped elements, with the analytic gradient:
+# every element is an ABCD matrix [[1, Z], [0, 1]] (series) or [[1, 0], [Y, 1]] (shunt), the derivative of the
+# cascade with respect to element i is prefix_i @ dM_i @ suffix_i, so one objective + gradient costs O(n) products
+# of [n_freq] arrays instead of n + 1 Network chains (finite differences)
+omega = 2 * np.pi * frequency.f
+z_load = Z_0 * (1 + antenna.s[:, 0, 0]) / (1 - antenna.s[:, 0, 0])
+
+
+def _get_element(comp, x):
+    # (Z or Y, d(Z or Y)/dx) of one element, x in units of comp.factor
+    value = x * comp.factor
+    if (comp.type == CompType.INDUCTOR) == (comp.key == CompKey.SERIES):
+        impedance = 1j * omega * value # series L: Z = jwL, shunt C: Y = jwC
+        return (impedance, 1j * omega * comp.factor)
+    impedance = 1 / (1j * omega * value) # series C: Z = 1/jwC, shunt L: Y = 1/jwL
+    return (impedance, -impedance / x)
+
+
+def _multiply(m1, m2):
+    # product of two ABCD matrices given as (a, b, c, d) arrays
+    (a1, b1, c1, d1) = m1
+    (a2, b2, c2, d2) = m2
+    return (a1 * a2 + b1 * c2, a1 * b2 + b1 * d2, c1 * a2 + d1 * c2, c1 * b2 + d1 * d2)
+
+
+def ladder_objective(variation):
+    def obj_fun_loc(x):
+        one = np.ones(len(omega), dtype=complex)
+        zero = np.zeros(len(omega), dtype=complex)
+        matrices = []
+        derivatives = []
+        for (comp, x_i) in zip(variation, x):
+            (impedance, d_impedance) = _get_element(comp, x_i)
+            if comp.key == CompKey.SERIES:
+                matrices.append((one, impedance, zero, one))
+            else:
+                matrices.append((one, zero, impedance, one))
+            derivatives.append(d_impedance)
+
+        prefixes = [(one, zero, zero, one)]
+        for matrix in matrices:
+            prefixes.append(_multiply(prefixes[-1], matrix))
+        suffixes = [(one, zero, zero, one)]
+        for matrix in reversed(matrices):
+            suffixes.append(_multiply(matrix, suffixes[-1]))
+        suffixes.reverse()
+
+        (a, b, c, d) = prefixes[-1]
+        numerator = a * z_load + b
+        denominator = c * z_load + d
+        z_in = numerator / denominator
+        gamma = (z_in - Z_0) / (z_in + Z_0)
+        magnitude = np.abs(gamma)
+
+        value = 0
+        gradient = np.zeros(len(x))
+        for band_slice in bands.slices:
+            k = band_slice.start + int(np.argmax(magnitude[band_slice])) # max_db of the band
+            value += 20 * np.log10(magnitude[k])
+            for (i, comp) in enumerate(variation):
+                (pa, pb, pc, pd) = (prefix[k] for prefix in prefixes[i])
+                (sa, sb, sc, sd) = (suffix[k] for suffix in suffixes[i + 1])
+                if comp.key == CompKey.SERIES:
+                    (da, db, dc, dd) = (pa * sc, pa * sd, pc * sc, pc * sd)
+                else:
+                    (da, db, dc, dd) = (pb * sa, pb * sb, pd * sa, pd * sb)
+                d_numerator = (da * z_load[k] + db) * derivatives[i][k]
+                d_denominator = (dc * z_load[k] + dd) * derivatives[i][k]
+                d_z_in = (d_numerator * denominator[k] - numerator[k] * d_denominator) / denominator[k] ** 2
+                d_gamma = 2 * Z_0 * d_z_in / (z_in[k] + Z_0) ** 2
+                d_magnitude = (np.conj(gamma[k]) * d_gamma).real / magnitude[k]
+                gradient[i] += 20 / np.log(10) * d_magnitude / magnitude[k]
+        return (value, gradient)
+
+    return obj_fun_loc
 
 
-def simulate(variations):
+def get_seeds(variation, starts, seed = 0):
+    # the fixed x0 + latin hypercube samples (log-uniform in SEED_RANGE) as starting points
+    x0 = np.array(get_starting_values(variation), dtype=float)
+    if starts <= 1:
+        return [x0]
+    (log_low, log_high) = np.log(SEED_RANGE)
+    samples = qmc.LatinHypercube(d=len(variation), seed=seed).random(starts - 1)
+    return [x0] + list(np.exp(log_low + samples * (log_high - log_low)))
+
+
+def sim_thread(task):
+    # one local optimization, no plotting here (runs in the pool)
+    (number, variation, x0) = task
+    res = minimize(ladder_objective(variation), x0, jac=True, bounds=get_bounds(variation))
+    return (number, res.x, res.fun)
+
+
+def get_distinct_solutions(solutions, tolerance = DEDUP_TOLERANCE):
+    '''
+    solutions: [(number of the topology, x, objective)]
+    drops every solution whose values are all within tolerance (relative) of a better solution of the same topology
+    returns the rest, best first
+    '''
+    distinct = []
+    for (number, x, fun) in sorted(solutions, key=lambda solution: (solution[2], solution[0])):
+        if not any(number == other[0] and np.all(np.abs(np.log(x / other[1])) < tolerance) for other in distinct):
+            distinct.append((number, x, fun))
+    return distinct
+
+
+def simulate(variations, starts = MULTISTART):
+    '''
+    multi-start search: starts local optimizations per topology, all of them spread over the pool
+    returns the distinct optima [(objective, variation, x)], best first
+    '''
+    variations = list(variations)
+    tasks = [(number, variation, x0) for (number, variation) in enumerate(variations)
+             for x0 in get_seeds(variation, starts, seed=number)]
     p = Pool()
-    result = p.map(sim_thread, variations)
-    for res in result:
-        print(res)
+    solutions = p.map(sim_thread, tasks)
+    return [(fun, variations[number], x) for (number, x, fun) in get_distinct_solutions(solutions)]
     #
     #for variation in variations:
     #    result = sim_thread(variation)
 
+
+class HybridEvaluator(matchingsim.BandEvaluator):
+    # same criterion as objective_function_3 (sum of the max S11 in dB of both bands) on the real parts
+    def __init__(self):
+        matchingsim.BandEvaluator.__init__(self, [band.name for band in bands.bands], metrics=['max_db'])
+
+    def score(self, indices, s11, frequency):
+        return matchingsim.BandEvaluator.score(self, indices, s11, frequency).sum(axis=-1)
+
+
+def hybrid(network_description, k = HYBRID_K):
+    '''
+    continuous optimization of every topology first (multi-start, see simulate()), then the discrete engine
+    only evaluates the combinations of the k real parts (test/components, measured S-parameters) with the
+    nominal values closest to each optimized value of every distinct optimum, instead of the whole variation space
+    returns (MatchingSimulationManager, [(variation number, score)] best first)
+    '''
+    ranked = simulate(_specific_order_cartesian(parse_network_template_description(network_description)))
+
+    manager = matchingsim.MatchingSimulationManager(antenna, HybridEvaluator(),
+                                                    [matchingsim.CompKey[key.name] for key in network_description],
+                                                    processes=1,
+                                                    series_dir=os.path.join(TEST_DIR, 'components', 'series'),
+                                                    shunt_dir=os.path.join(TEST_DIR, 'components', 'shunt'))
+    library = manager.network_library
+    part_index = matchingsim.PartIndex(library)
+    numbers = set()
+    for (fun, variation, x) in ranked[:HYBRID_OPTIMA]:
+        slots = []
+        for (position, (key, comp)) in enumerate(zip(network_description, variation)):
+            kind = 'L' if comp.type == CompType.INDUCTOR else 'C'
+            value = x[position] * comp.factor
+            slots.append(part_index.nearest(library.variation_template[position], kind, key == CompKey.SHUNT, value, k))
+        for candidate in product(*slots):
+            numbers.add(library.variation_space.index_of(candidate))
+
+    print('hybrid: %d of %d variations' % (len(numbers), len(library.variation_space)))
+    (numbers, scores, feasible) = manager.evaluate_variations(sorted(numbers))
+    order = np.lexsort((numbers, scores))
+    return (manager, [(int(numbers[i]), float(scores[i])) for i in order if feasible[i]])
+
+
 if __name__ == '__main__':
     start_time = time.time()
     network_description = [CompKey.SERIES, CompKey.SHUNT, CompKey.SERIES]
     variation_template = parse_network_template_description(network_description)
     variations = _specific_order_cartesian(variation_template)
-    simulate(variations)
+    if HYBRID:
+        (manager, ranked) = hybrid(network_description)
+        for (i, score) in ranked[:10]:
+            (_, ntw, variation) = manager.get_result(i)
+            print(i, score, [component.name for component in variation])
+            ntw.plot_s_db(lw=2)
+    else:
+        ranked = simulate(variations)
+        for (fun, variation, x) in ranked[:10]:
+            print('%.3f dB  %s  %s' % (fun, [comp.netfun.__name__ for comp in variation], x))
+            matching_network(variation)(*x).plot_s_db(lw=2)
     lte.plot_s_db(lw=2)
     save_all_figs('./plots', format=['pdf'])
     end_time = time.time()
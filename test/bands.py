@@ -0,0 +1,140 @@
+import re
+import numpy as np
+
+FREQUENCY_MULTIPLIERS = {'hz': 1, 'khz': 1e3, 'mhz': 1e6, 'ghz': 1e9, 'thz': 1e12}
+
+
+class Band():
+    def __init__(self, f_start, f_stop, name = None):
+        self.f_start = f_start # Hz
+        self.f_stop = f_stop # Hz
+        self.name = name
+
+    @classmethod
+    def from_string(cls, band_str, default_unit = 'hz'):
+        '''
+        same notation as skrf network slicing, e.g. '791mhz-861mhz', '1.7-1.9ghz'
+        '''
+        match = re.fullmatch(r'\s*([\d.]+)\s*([a-z]*)\s*-\s*([\d.]+)\s*([a-z]*)\s*', band_str.lower())
+        if match is None:
+            raise ValueError('invalid band: ' + band_str)
+        (start, start_unit, stop, stop_unit) = match.groups()
+        stop_unit = stop_unit or default_unit
+        start_unit = start_unit or stop_unit
+        if start_unit not in FREQUENCY_MULTIPLIERS or stop_unit not in FREQUENCY_MULTIPLIERS:
+            raise ValueError('invalid frequency unit in band: ' + band_str)
+        return cls(float(start) * FREQUENCY_MULTIPLIERS[start_unit], float(stop) * FREQUENCY_MULTIPLIERS[stop_unit], name=band_str)
+
+
+class BandSpec():
+    '''
+    set of bands compiled once against a frequency grid into index slices
+    (the same points as network['791mhz-861mhz'], i.e. nearest points of the band edges, inclusive)
+    the metrics are computed on raw S11 arrays [n_freq] or [batch, n_freq], one pass per band:
+    - max_db, min_db, mean_db: |S11| in dB
+    - max_vswr
+    - max_mismatch_loss_db: worst case mismatch loss in dB
+    '''
+    METRICS = ('max_db', 'min_db', 'mean_db', 'max_vswr', 'max_mismatch_loss_db')
+
+    def __init__(self, bands, frequency):
+        self.bands = [band if isinstance(band, Band) else Band.from_string(band, frequency.unit.lower()) for band in bands]
+        self.frequency = frequency
+        self.f = np.array(frequency.f)
+        self.slices = [slice(self._nearest_index(band.f_start), self._nearest_index(band.f_stop) + 1) for band in self.bands]
+
+
+    def _nearest_index(self, f):
+        return int(np.argmin(np.abs(self.f - f)))
+
+
+    def matches(self, frequency):
+        # True if the spec was compiled for this frequency grid
+        return frequency is self.frequency or np.array_equal(frequency.f, self.f)
+
+
+    def metrics(self, s11, names = ('max_db',)):
+        '''
+        returns [n_bands * len(names)] for s11 [n_freq], [batch, n_bands * len(names)] for s11 [batch, n_freq]
+        columns: all names for band 0, then all names for band 1, ...
+        '''
+        columns = []
+        for band in range(len(self.bands)):
+            magnitude = np.abs(s11[..., self.slices[band]])
+            columns += [_compute_metric(magnitude, name) for name in names]
+        return np.stack(columns, axis=-1)
+
+
+    def metric(self, s11, name, band = 0):
+        return _compute_metric(np.abs(s11[..., self.slices[band]]), name)
+
+
+class ReflectionBound():
+    '''
+    branch and bound test for band limits (see CascadeEngine.iter_block())
+    prune() gets a lower bound of |S11| [n_freq] for a whole subtree of variations and
+    returns True if no variation of the subtree can meet the limits anymore:
+    - max_db, max_vswr, max_mismatch_loss_db: the bound reaches the limit on any point of the band
+    - min_db: the bound reaches the limit on all points of the band
+    - mean_db: the mean of the bound in dB reaches the limit
+    limits: [(band number, metric name, upper limit)] as for BandEvaluator
+    '''
+    def __init__(self, band_spec, limits):
+        self.tests = [(band_spec.slices[band], name, _get_magnitude_limit(name, limit)) for (band, name, limit) in limits]
+        self.n_freq = len(band_spec.f)
+
+    def get_pointwise_limit(self):
+        '''
+        upper limit of |S11| [n_freq] that every point has to meet (max_db, max_vswr, max_mismatch_loss_db),
+        inf where no such limit applies (min_db and mean_db don't constrain single points)
+        '''
+        limit = np.full(self.n_freq, np.inf)
+        for (band_slice, name, magnitude) in self.tests:
+            if name not in ('min_db', 'mean_db'):
+                limit[band_slice] = np.minimum(limit[band_slice], magnitude)
+        return limit
+
+    def prune(self, lower_bound):
+        for (band_slice, name, limit) in self.tests:
+            band_bound = lower_bound[band_slice]
+            if name == 'min_db':
+                if np.all(band_bound >= limit):
+                    return True
+            elif name == 'mean_db':
+                with np.errstate(divide='ignore'):
+                    if (20 * np.log10(band_bound)).mean() >= limit:
+                        return True
+            elif np.any(band_bound >= limit):
+                return True
+        return False
+
+
+# limit of a metric as limit of |S11| (mean_db stays in dB)
+def _get_magnitude_limit(name, limit):
+    if name in ('max_db', 'min_db'):
+        return 10 ** (limit / 20)
+    if name == 'max_vswr':
+        return (limit - 1) / (limit + 1)
+    if name == 'max_mismatch_loss_db':
+        return np.sqrt(1 - 10 ** (-limit / 10))
+    if name == 'mean_db':
+        return limit
+    raise ValueError('unknown band metric: ' + name)
+
+
+def _compute_metric(magnitude, name):
+    # magnitude: |S11| of one band [..., n_band_points]
+    # max/min are taken on the magnitude first, the dB conversion is monotonic
+    if name == 'max_db':
+        return 20 * np.log10(magnitude.max(axis=-1))
+    if name == 'min_db':
+        return 20 * np.log10(magnitude.min(axis=-1))
+    if name == 'mean_db':
+        return (20 * np.log10(magnitude)).mean(axis=-1)
+    if name == 'max_vswr':
+        worst = magnitude.max(axis=-1)
+        return (1 + worst) / (1 - worst)
+    if name == 'max_mismatch_loss_db':
+        worst = magnitude.max(axis=-1)
+        return -10 * np.log10(1 - worst ** 2)
+    raise ValueError('unknown band metric: ' + name)
@@ -0,0 +1,229 @@
+'''
+benchmark of the matching pipeline with synthetic component libraries
+
+generates series/shunt L and C parts (ideal or with parasitics) as Touchstone files,
+then times every stage of the pipeline for each topology and reports variations/s and the peak RSS
+of every sweep (each sweep runs in a fresh process, pool workers not included)
+
+usage: python benchmark.py --parts 6 --points 1301 --parasitic --topologies SERIES,SHUNT,SERIES SERIES,SHUNT,SERIES,SHUNT
+'''
+import skrf as rf
+import numpy as np
+import argparse
+import json
+import logging
+import multiprocessing
+import os
+import tempfile
+import time
+from itertools import islice
+from matchingsim import *
+from metrics import get_peak_rss
+
+
+class BenchmarkEvaluator(BandEvaluator):
+    def __init__(self):
+        BandEvaluator.__init__(self, ['791mhz-861mhz', '1710mhz-1880mhz'], metrics=['max_db'],
+                               limits=[(0, 'max_db', -3), (1, 'max_db', -3)])
+
+
+def make_part(line, kind, value, parasitic):
+    # impedance of an L or C part, with parasitic: ESR + self resonance
+    omega = 2 * np.pi * line.frequency.f
+    if kind == 'L':
+        z = 1j * omega * value
+        if parasitic:
+            z = (0.05 * np.sqrt(value / 1e-9) + z) / (1 + (0.05 * np.sqrt(value / 1e-9) + z) * 1j * omega * 0.05e-12)
+    else:
+        z = 1 / (1j * omega * value)
+        if parasitic:
+            z = z + 0.1 + 1j * omega * 0.4e-9
+    return z
+
+
+def generate_library(root, parts, points, f_start, f_stop, parasitic):
+    '''
+    writes components/series/{L,C} and components/shunt/{L,C} with parts values each
+    plus a synthetic 1-port dut, returns the dut
+    '''
+    frequency = rf.Frequency(f_start, f_stop, points, 'mhz')
+    line = rf.DefinedGammaZ0(frequency=frequency, z0=Z_0)
+    values = {
+        'L': np.geomspace(1e-9, 33e-9, parts),
+        'C': np.geomspace(0.3e-12, 12e-12, parts),
+    }
+    for kind in values:
+        for (k, value) in enumerate(values[kind]):
+            z = make_part(line, kind, value, parasitic)
+            series = line.resistor(z)
+            shunt = line.shunt(line.resistor(z) ** line.short())
+            for (network, topology) in ((series, 'series'), (shunt, 'shunt')):
+                directory = os.path.join(root, 'components', topology, kind)
+                os.makedirs(directory, exist_ok=True)
+                network.name = '%s_%s_%02d' % (topology, kind, k)
+                network.comments = 'Vendor: synthetic\nValue: %.4g %s' % ((value * 1e9, 'nH') if kind == 'L' else (value * 1e12, 'pF'))
+                network.write_touchstone(network.name, directory)
+
+    dut = line.inductor(6e-9) ** line.shunt_capacitor(1.8e-12) ** line.load(rf.mathFunctions.db_2_magnitude(-0.8))
+    dut.name = 'dut'
+    return dut
+
+
+def timed(timings, key, function, *args):
+    start = time.perf_counter()
+    result = function(*args)
+    timings[key] = time.perf_counter() - start
+    return result
+
+
+def benchmark_stages(description, dut, sample):
+    '''
+    startup stages and the per variation stages of the original Network ** Network path
+    '''
+    timings = {}
+    library = timed(timings, 'read_library', MatchingNetworkLibrary)
+    library.network_description = description
+    dut = timed(timings, 'make_frequencies_common', library._make_frequencies_common, dut)
+    library.line = rf.DefinedGammaZ0(frequency=library.frequency, z0=Z_0)
+    timed(timings, 'shared_arrays', library._init_shared_arrays)
+    timed(timings, 'cascade_engine', library._init_engine)
+    library.variation_template = library._parse_network_template_description(description)
+    library.variation_space = VariationSpace(library.variation_template)
+
+    evaluator = BenchmarkEvaluator()
+    variations = list(islice(iter(library.variation_space), sample))
+    build = cascade = evaluate = 0
+    for (i, variation) in enumerate(variations):
+        start = time.perf_counter()
+        network = library._build_network(variation)
+        build += time.perf_counter() - start
+        start = time.perf_counter()
+        result_network = network ** dut # sim_thread()
+        cascade += time.perf_counter() - start
+        start = time.perf_counter()
+        evaluator.evaluate((i, result_network, variation))
+        evaluate += time.perf_counter() - start
+    timings['build_network_per_variation'] = build / len(variations)
+    timings['sim_thread_per_variation'] = cascade / len(variations)
+    timings['evaluate_per_variation'] = evaluate / len(variations)
+    timings['networks_variations_per_s'] = len(variations) / (build + cascade + evaluate)
+    return timings
+
+
+SWEEP_MODES = {
+    'batched': dict(processes=1),
+    'prefix': dict(processes=1, prefix_sharing=True),
+    'branch_and_bound': dict(processes=1, branch_and_bound=True),
+    'parallel': dict(),
+    'pipeline': dict(processes=1, pipeline=True),
+    'coarse': dict(processes=1, coarse_step=8),
+}
+
+
+def run_sweep(description, dut, options, connection):
+    # runs in its own (spawned) process, so the peak rss is the one of this sweep only
+    start = time.perf_counter()
+    manager = MatchingSimulationManager(dut, BenchmarkEvaluator(), description, **options)
+    startup = time.perf_counter() - start
+    start = time.perf_counter()
+    manager.simulate()
+    elapsed = time.perf_counter() - start
+    variations = len(manager.network_library.variation_space)
+    result = {
+        'startup_s': startup,
+        'sweep_s': elapsed,
+        'variations': variations,
+        'evaluated': manager.metrics.timers.get('collect', [0, 0.0, 0])[2], # scored variations (not pruned)
+        'variations_per_s': variations / elapsed,
+        'process_peak_rss_mb': get_peak_rss(), # interpreter + imports + sweep, without the pool workers
+    }
+    if manager.pipeline_stats:
+        result['pipeline_stages'] = manager.pipeline_stats
+    connection.send(result)
+
+
+def benchmark_sweeps(description, dut, modes, processes):
+    results = {}
+    context = multiprocessing.get_context('spawn') # a forked child would start with the pages of this process
+    for mode in modes:
+        options = dict(SWEEP_MODES[mode])
+        if mode == 'parallel':
+            options['processes'] = processes
+        (receiver, sender) = context.Pipe(duplex=False)
+        process = context.Process(target=run_sweep, args=(description, dut, options, sender))
+        process.start()
+        sender.close()
+        try:
+            results[mode] = receiver.recv()
+        except EOFError:
+            process.join()
+            raise RuntimeError('the %s sweep failed (exit code %s)' % (mode, process.exitcode))
+        process.join()
+    return results
+
+
+def parse_topology(topology):
+    return [CompKey[key.strip().upper()] for key in topology.split(',')]
+
+
+def print_report(report):
+    for (topology, result) in report['topologies'].items():
+        print('=== %s (%d variations)' % (topology, result['variations']))
+        for (key, value) in result['stages'].items():
+            if key.endswith('per_variation'):
+                print('  %-32s %10.1f us' % (key, value * 1e6))
+            elif key.endswith('per_s'):
+                print('  %-32s %10.0f' % (key, value))
+            else:
+                print('  %-32s %10.3f s' % (key, value))
+        for (mode, sweep) in result['sweeps'].items():
+            rss = 'n/a' if sweep['process_peak_rss_mb'] is None else '%.0f MB' % sweep['process_peak_rss_mb']
+            print('  %-16s startup %7.2f s  sweep %8.2f s  %10.0f variations/s  evaluated %9d  process peak rss %s' % (
+                mode, sweep['startup_s'], sweep['sweep_s'], sweep['variations_per_s'], sweep['evaluated'], rss))
+            for stage in sweep.get('pipeline_stages', ()):
+                print('    %-14s workers %2d  items %6d  busy %8.2f s  utilization %5.1f %%' % (
+                    stage['stage'], stage['workers'], stage['items'], stage['busy_s'], stage['utilization'] * 100))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='benchmark of the matching pipeline with synthetic component libraries')
+    parser.add_argument('--parts', type=int, default=6, help='values per part type (L/C) and topology (series/shunt)')
+    parser.add_argument('--points', type=int, default=1301, help='frequency points of the parts')
+    parser.add_argument('--f-start', type=float, default=700, help='MHz')
+    parser.add_argument('--f-stop', type=float, default=2000, help='MHz')
+    parser.add_argument('--parasitic', action='store_true', help='ESR + self resonance instead of ideal parts')
+    parser.add_argument('--topologies', nargs='+', default=['SERIES,SHUNT,SERIES', 'SERIES,SHUNT,SERIES,SHUNT'])
+    parser.add_argument('--modes', nargs='+', default=['batched', 'prefix', 'branch_and_bound'], choices=list(SWEEP_MODES))
+    parser.add_argument('--processes', type=int, default=os.cpu_count())
+    parser.add_argument('--sample', type=int, default=200, help='variations for the per variation stages')
+    parser.add_argument('--json', help='write the report to this file')
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.WARNING)
+    json_path = os.path.abspath(args.json) if args.json else None
+    report = {'arguments': vars(args), 'topologies': {}}
+    with tempfile.TemporaryDirectory() as root:
+        dut = generate_library(root, args.parts, args.points, args.f_start, args.f_stop, args.parasitic)
+        cwd = os.getcwd()
+        os.chdir(root) # the library reads components/ relative to the working directory
+        try:
+            for topology in args.topologies:
+                description = parse_topology(topology)
+                stages = benchmark_stages(description, dut, args.sample)
+                sweeps = benchmark_sweeps(description, dut, args.modes, args.processes)
+                report['topologies'][topology] = {
+                    'variations': next(iter(sweeps.values()))['variations'] if sweeps else None,
+                    'stages': stages,
+                    'sweeps': sweeps,
+                }
+        finally:
+            os.chdir(cwd)
+
+    print_report(report)
+    if json_path:
+        with open(json_path, 'w') as f:
+            json.dump(report, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
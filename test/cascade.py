@@ -0,0 +1,233 @@
+import skrf as rf
+import numpy as np
+
+
+class CascadeEngine():
+    '''
+    vectorized replacement for chaining Network ** Network in _build_network()
+    - every component is converted into an ABCD matrix exactly once
+    - whole batches of variations are cascaded with batched matmuls
+    - the cascades are terminated directly into the reflection coefficient of the dut
+    only the winners have to be turned back into skrf Networks (see to_network())
+    abcd: precomputed matrices instead of networks, e.g. a read-only memmap from load_matrices(),
+    a memmapped engine is pickled as its file name so pool workers map the same pages
+    '''
+    def __init__(self, networks, frequency, z0 = 50, abcd = None):
+        self.frequency = frequency
+        self.z0 = z0
+        # [n_components, n_freq, 2, 2]
+        if abcd is None:
+            abcd = np.stack([rf.network.s2a(network.s, network.z0) for network in networks])
+        self.path = None
+        if isinstance(abcd, np.memmap) and abcd.filename:
+            self.path = abcd.filename
+            abcd = abcd.view(np.ndarray) # same pages, without the memmap overhead on every slice
+        self.abcd = abcd
+
+
+    def __getstate__(self):
+        state = dict(self.__dict__)
+        if self.path:
+            state['abcd'] = None
+        return state
+
+
+    def __setstate__(self, state):
+        if state['path']:
+            state['abcd'] = load_matrices(state['path']).view(np.ndarray)
+        self.__dict__.update(state)
+
+
+    def __len__(self):
+        return self.abcd.shape[0]
+
+
+    def cascade(self, indices):
+        '''
+        indices: integer array [batch, depth], every row holds the component indices of one variation
+        returns the ABCD matrices of the cascades [batch, n_freq, 2, 2]
+        '''
+        indices = np.asarray(indices)
+        result = self.abcd[indices[:, 0]]
+        for depth in range(1, indices.shape[1]):
+            result = result @ self.abcd[indices[:, depth]]
+        return result
+
+
+    def cascade_product(self, index_lists):
+        '''
+        ABCD matrices of all cascades in the cartesian product of index_lists,
+        same order as itertools.product [n_1 * ... * n_k, n_freq, 2, 2]
+        '''
+        result = self.abcd[index_lists[0]]
+        for indices in index_lists[1:]:
+            result = (result[:, None] @ self.abcd[indices][None, :]).reshape(-1, *result.shape[1:])
+        return result
+
+
+    def iter_block(self, index_lists, gamma_load, batch_size, bound = None):
+        '''
+        prefix sharing evaluation of the cartesian product of index_lists (same order as itertools.product)
+        - the trailing slots that fit into batch_size are multiplied out once per block
+        - the leading slots are walked depth first, the partial cascade of every depth is passed down
+          so every candidate costs about one matmul + the termination
+        bound: optional branch and bound test, bound.prune(lower_bound) gets a lower bound of |S11| [n_freq]
+        for all variations below a node of the walk and returns True to skip them (see _get_regions())
+        yields (offset of the first variation in the block, positions in the leading slots, s11 [n_trailing, n_freq])
+        '''
+        split = len(index_lists) - 1
+        size = len(index_lists[split])
+        while split > 0 and size * len(index_lists[split - 1]) <= batch_size:
+            split -= 1
+            size *= len(index_lists[split])
+
+        suffix = self.cascade_product(index_lists[split:])
+        regions = None
+        if bound is not None:
+            regions = self._get_regions(index_lists[:split], suffix, gamma_load)
+            if bound.prune(_get_lower_bound(*regions[0])):
+                return
+        if split == 0:
+            yield (0, (), self.terminate(suffix, gamma_load))
+            return
+
+        strides = [len(suffix)] * split
+        for depth in reversed(range(split - 1)):
+            strides[depth] = strides[depth + 1] * len(index_lists[depth + 1])
+        yield from self._walk(index_lists[:split], strides, suffix, gamma_load, bound, regions, (), None, 0)
+
+
+    def _walk(self, index_lists, strides, suffix, gamma_load, bound, regions, positions, partial, offset):
+        depth = len(positions)
+        for (position, index) in enumerate(index_lists[depth]):
+            abcd = self.abcd[index] if partial is None else partial @ self.abcd[index]
+            if bound is not None and bound.prune(_get_lower_bound(*self.transform_disk(abcd, *regions[depth + 1]))):
+                continue
+            sub_positions = positions + (position,)
+            sub_offset = offset + position * strides[depth]
+            if depth + 1 == len(index_lists):
+                yield (sub_offset, sub_positions, self.terminate(abcd @ suffix, gamma_load))
+            else:
+                yield from self._walk(index_lists, strides, suffix, gamma_load, bound, regions, sub_positions, abcd, sub_offset)
+
+
+    def _get_regions(self, index_lists, suffix, gamma_load):
+        '''
+        regions[k]: disk (center, radius) [n_freq] that contains the reflection coefficient seen into
+        slot k for every choice of the slots k.. + the dut
+        (the trailing slots are exact, every leading slot maps the disk behind it with each of its components)
+        regions[0] bounds the whole block, regions[k + 1] everything behind a node at depth k of the walk
+        '''
+        # several dut states are treated like more variations, the bound then holds for the best state
+        # (pruning stays safe, a subtree is only skipped if it fails in every state)
+        gamma = self.terminate(suffix, gamma_load).reshape(-1, len(self.frequency))
+        center = gamma.mean(axis=0)
+        regions = [None] * len(index_lists) + [(center, np.abs(gamma - center).max(axis=0))]
+        for depth in reversed(range(len(index_lists))):
+            (centers, radii) = self.transform_disk(self.abcd[index_lists[depth]], *regions[depth + 1])
+            regions[depth] = _get_bounding_disk(centers, radii)
+        return regions
+
+
+    def transform_disk(self, abcd, center, radius):
+        '''
+        image of the disk |gamma - center| <= radius at the output of abcd [..., n_freq, 2, 2] seen at its input
+        (the termination is a moebius transform, disks are mapped to disks)
+        returns (center, radius), radius is inf if the image is not bounded
+        '''
+        return _transform_disk(self._get_moebius(abcd), center, radius)
+
+
+    def get_load_region(self, abcd, radius):
+        '''
+        inverse of transform_disk() for disks around 0: the loads at the output of abcd [..., n_freq, 2, 2]
+        that give |gamma| <= radius at its input lie in the returned disk (center, radius)
+        radius is inf if that set is not bounded (then nothing can be excluded)
+        '''
+        (alpha, beta, gamma, delta) = self._get_moebius(abcd)
+        return _transform_disk((delta, -beta, -gamma, alpha), 0, radius)
+
+
+    def _get_moebius(self, abcd):
+        # terminate() as (alpha * gamma_load + beta) / (gamma * gamma_load + delta)
+        z0 = self.z0
+        (a, b, c, d) = (abcd[..., 0, 0], abcd[..., 0, 1], abcd[..., 1, 0], abcd[..., 1, 1])
+        return ((a * z0 - b) - z0 * (c * z0 - d),
+                (a * z0 + b) - z0 * (c * z0 + d),
+                (a * z0 - b) + z0 * (c * z0 - d),
+                (a * z0 + b) + z0 * (c * z0 + d))
+
+
+    def terminate(self, abcd, gamma_load):
+        '''
+        reflection coefficient at the input of abcd [..., n_freq, 2, 2] when terminated with gamma_load [n_freq]
+        (same as network ** dut, written in terms of gamma so open/short loads don't blow up)
+        gamma_load [n_states, n_freq]: several duts at once, returns [..., n_states, n_freq]
+        '''
+        if np.ndim(gamma_load) == 2:
+            abcd = abcd[..., None, :, :, :]
+        a = abcd[..., 0, 0]
+        b = abcd[..., 0, 1]
+        c = abcd[..., 1, 0]
+        d = abcd[..., 1, 1]
+        z0 = self.z0
+        num = a * z0 * (1 + gamma_load) + b * (1 - gamma_load)
+        den = (c * z0 * (1 + gamma_load) + d * (1 - gamma_load)) * z0
+        return (num - den) / (num + den)
+
+
+    def evaluate(self, indices, gamma_load):
+        '''
+        cascade + terminate, returns s11 [batch, n_freq] ([batch, n_states, n_freq] for several duts)
+        '''
+        return self.terminate(self.cascade(indices), gamma_load)
+
+
+    def to_network(self, s11, name = ''):
+        '''
+        turns a single row of evaluate() back into a 1-port skrf Network
+        '''
+        return rf.Network(frequency=self.frequency, s=s11.reshape(-1, 1, 1), z0=self.z0, name=name)
+
+
+# image of the disk |w - center| <= radius under (alpha * w + beta) / (gamma * w + delta)
+def _transform_disk(moebius, center, radius):
+    (alpha, beta, gamma, delta) = moebius
+    finite = np.isfinite(radius)
+    radius = np.where(finite, radius, 0)
+    # substitute w = center + radius * u, |u| <= 1
+    a = alpha * radius
+    b = alpha * center + beta
+    c = gamma * radius
+    d = gamma * center + delta
+    denominator = np.abs(d) ** 2 - np.abs(c) ** 2
+    bounded = (denominator > 0) & finite
+    denominator = np.where(bounded, denominator, 1)
+    image_center = np.where(bounded, (b * np.conj(d) - a * np.conj(c)) / denominator, 0)
+    image_radius = np.where(bounded, np.abs(a * d - b * c) / denominator, np.inf)
+    return (image_center, image_radius)
+
+
+# disk [n_freq] that contains all disks (centers, radii) [n, n_freq]
+def _get_bounding_disk(centers, radii):
+    bounded = np.all(np.isfinite(radii), axis=0)
+    centers = np.where(bounded, centers, 0)
+    center = centers.mean(axis=0)
+    radius = (np.abs(centers - center) + np.where(bounded, radii, 0)).max(axis=0)
+    return (center, np.where(bounded, radius, np.inf))
+
+
+# lower bound of |gamma| [n_freq] inside the disks (with some slack for rounding errors)
+def _get_lower_bound(center, radius):
+    return np.maximum(np.abs(center) - radius - 1e-9, 0)
+
+
+# s2a() returns the matrices with the frequency as the innermost axis, batched matmuls of 2x2 matrices
+# are about twice as fast in that layout as in C order, so the files keep it ([n, 2, 2, n_freq] on disk)
+def save_matrices(path, abcd):
+    np.save(path, np.ascontiguousarray(np.asarray(abcd).transpose(0, 2, 3, 1)))
+
+
+def load_matrices(path):
+    # read-only memmap [n, n_freq, 2, 2]
+    return np.load(path, mmap_mode='r').transpose(0, 3, 1, 2)
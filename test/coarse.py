@@ -0,0 +1,70 @@
+import skrf as rf
+import numpy as np
+from cascade import CascadeEngine
+
+
+class CoarseScreen():
+    '''
+    first tier of the two tier evaluation: the limits of a ReflectionBound (Evaluator.get_bound()) are tested
+    on every step-th point of the limited bands (+ the band edges), only the survivors are cascaded on the full grid
+    - max_db, max_vswr, max_mismatch_loss_db: a coarse point above the limit is a point of the full grid
+      above the limit, these tests never reject a candidate that passes on the full grid
+    - min_db, mean_db: the coarse grid can miss the best points, the limit is raised by margin_db
+    engine: the engine of the full grid, a CascadeEngine on the coarse points is built from it
+    also works as the bound of CascadeEngine.iter_block() on the coarse engine (see prune())
+    '''
+    def __init__(self, engine, bound, step = 8, margin_db = 1.0):
+        selected = []
+        for (band_slice, name, limit) in bound.tests:
+            band = np.arange(band_slice.start, band_slice.stop)
+            selected.append(np.union1d(band[::step], band[-1:]))
+        self.points = np.unique(np.concatenate(selected))
+        self.tests = []
+        for ((band_slice, name, limit), band_points) in zip(bound.tests, selected):
+            if name == 'min_db':
+                limit = limit * 10 ** (margin_db / 20)
+            elif name == 'mean_db':
+                limit = limit + margin_db
+            self.tests.append((np.searchsorted(self.points, band_points), name, limit))
+        frequency = rf.Frequency.from_f(engine.frequency.f[self.points], unit='hz')
+        self.engine = CascadeEngine(None, frequency, z0=engine.z0, abcd=np.ascontiguousarray(engine.abcd[:, self.points]))
+        self.n_freq = len(engine.frequency)
+
+
+    def get_gamma_load(self, gamma_load):
+        return gamma_load[..., self.points]
+
+
+    def evaluate(self, indices, gamma_load):
+        # s11 on the coarse points [batch, n_points] (gamma_load on the full grid)
+        return self.engine.evaluate(indices, self.get_gamma_load(gamma_load))
+
+
+    def screen(self, s11):
+        '''
+        s11: coarse reflection coefficients [batch, n_points] or [batch, n_states, n_points]
+        returns the mask of the candidates that can still pass (in every state)
+        '''
+        fails = self._fails(np.abs(s11))
+        if fails.ndim > 1:
+            fails = fails.any(axis=1)
+        return ~fails
+
+
+    def prune(self, lower_bound):
+        # same interface as ReflectionBound.prune(), lower_bound on the coarse points
+        return bool(self._fails(lower_bound))
+
+
+    def _fails(self, magnitude):
+        fails = np.zeros(magnitude.shape[:-1], dtype=bool)
+        for (points, name, limit) in self.tests:
+            band = magnitude[..., points]
+            if name == 'min_db':
+                fails |= band.min(axis=-1) >= limit
+            elif name == 'mean_db':
+                with np.errstate(divide='ignore'):
+                    fails |= (20 * np.log10(band)).mean(axis=-1) >= limit
+            else:
+                fails |= band.max(axis=-1) >= limit
+        return fails
@@ -0,0 +1,113 @@
+import heapq
+import numpy as np
+
+
+# collectors get the records of every batch (numbers, Evaluator.score(), Evaluator.screen()) and
+# can be merged, the parallel sweep fills one empty() copy per shard and merges them in order
+
+
+class TopKCollector():
+    '''
+    bounded heap of the k feasible candidates with the lowest score (column metric of a multi column score)
+    O(log k) per candidate, most of a batch is already dropped by comparing against the current worst entry
+    ties are broken by the variation number, so the result does not depend on the merge order
+    '''
+    def __init__(self, k, metric = 0):
+        self.k = k
+        self.metric = metric
+        self.heap = [] # (-score, -number), heap[0] is the worst entry
+
+    def empty(self):
+        return TopKCollector(self.k, self.metric)
+
+    def clear(self):
+        self.heap = []
+
+    def add(self, number, score):
+        entry = (-score, -number)
+        if len(self.heap) < self.k:
+            heapq.heappush(self.heap, entry)
+        elif entry > self.heap[0]:
+            heapq.heapreplace(self.heap, entry)
+
+    def add_batch(self, numbers, scores, feasible):
+        scores = np.asarray(scores)
+        if scores.ndim > 1:
+            scores = scores[:, self.metric]
+        scores = scores[feasible]
+        numbers = np.asarray(numbers)[feasible]
+        if len(self.heap) == self.k:
+            candidates = scores <= -self.heap[0][0]
+            scores = scores[candidates]
+            numbers = numbers[candidates]
+        for (number, score) in zip(numbers.tolist(), scores.tolist()):
+            self.add(number, score)
+
+    def merge(self, other):
+        for (score, number) in other.heap:
+            self.add(-number, -score)
+
+    def results(self):
+        # [(number, score)], best first
+        return sorted(((-number, -score) for (score, number) in self.heap), key=lambda entry: (entry[1], entry[0]))
+
+
+class ParetoCollector():
+    '''
+    non-dominated set of the feasible candidates over several score columns (all minimized),
+    e.g. the worst case S11 in 791-861 MHz and in 1710-1880 MHz
+    metrics: score columns to use, None -> all
+    '''
+    def __init__(self, metrics = None):
+        self.metrics = metrics
+        self.numbers = np.zeros(0, dtype=np.int64)
+        self.points = None
+
+    def empty(self):
+        return ParetoCollector(self.metrics)
+
+    def clear(self):
+        self.numbers = np.zeros(0, dtype=np.int64)
+        self.points = None
+
+    def add_batch(self, numbers, scores, feasible):
+        points = np.asarray(scores, dtype=float)
+        if points.ndim == 1:
+            points = points[:, None]
+        if self.metrics is not None:
+            points = points[:, self.metrics]
+        self._update(np.asarray(numbers, dtype=np.int64)[feasible], points[feasible])
+
+    def merge(self, other):
+        if other.points is not None:
+            self._update(other.numbers, other.points)
+
+    def _update(self, numbers, points):
+        if len(numbers) == 0:
+            return
+        if self.points is not None:
+            numbers = np.concatenate([self.numbers, numbers])
+            points = np.concatenate([self.points, points])
+        keep = _get_pareto_mask(points)
+        self.numbers = numbers[keep]
+        self.points = points[keep]
+        order = np.argsort(self.numbers, kind='stable')
+        self.numbers = self.numbers[order]
+        self.points = self.points[order]
+
+    def results(self):
+        # [(number, point)], ordered by variation number
+        if self.points is None:
+            return []
+        return list(zip(self.numbers.tolist(), self.points))
+
+
+def _get_pareto_mask(points):
+    # True for every point that is not dominated by another one (minimization)
+    mask = np.ones(len(points), dtype=bool)
+    for (k, point) in enumerate(points):
+        if not mask[k]:
+            continue
+        dominated = np.all(point <= points, axis=1) & np.any(point < points, axis=1)
+        mask &= ~dominated
+    return mask
@@ -0,0 +1,208 @@
+import os
+import re
+import json
+import logging
+
+INDEX_VERSION = 2 # bump when the parser changes, old entries are rescanned
+HEADER_LINES = 64 # the header is read up to the option line, but never further than this
+
+UNITS = {'ph': 1e-12, 'nh': 1e-9, 'uh': 1e-6, 'µh': 1e-6, 'ff': 1e-15, 'pf': 1e-12, 'nf': 1e-9, 'uf': 1e-6, 'µf': 1e-6}
+VENDORS = {
+    'murata': 'Murata', 'tdk': 'TDK', 'coilcraft': 'Coilcraft', 'johanson': 'Johanson', 'samsung': 'Samsung',
+    'taiyo': 'Taiyo Yuden', 'kyocera': 'Kyocera AVX', 'avx': 'Kyocera AVX', 'kemet': 'Kemet', 'vishay': 'Vishay',
+    'wurth': 'Wurth', 'würth': 'Wurth', 'synthetic': 'Synthetic',
+}
+# part number patterns: (regex, vendor, kind, size codes), all groups are the product series, group 2 the size code
+PART_NUMBERS = [
+    (r'^(LQ[A-Z])(\d\d)', 'Murata', 'L', {'03': '0201', '15': '0402', '18': '0603', '21': '0805'}),
+    (r'^(G[RJQ]M)(\d\d)', 'Murata', 'C', {'03': '0201', '15': '0402', '18': '0603', '21': '0805'}),
+    (r'^(ML[GK]|MHQ)(\d{4})', 'TDK', 'L', {'0603': '0201', '1005': '0402', '1608': '0603', '2012': '0805'}),
+    (r'^(C)(\d{4})', 'TDK', 'C', {'0603': '0201', '1005': '0402', '1608': '0603', '2012': '0805'}),
+    (r'^(CL)(\d\d)', 'Samsung', 'C', {'03': '0201', '05': '0402', '10': '0603', '21': '0805'}),
+    (r'^()(0201|0402|0603|0805)(CS|HP|DC|HL)', 'Coilcraft', 'L', None),
+]
+# capacitor series: characters between the size code and the capacitance code (thickness, characteristic, voltage)
+# GRM15 55C 1H 1R0 CA01, C1005 C0G 1H 100 C050BA, CL05 C 1R5 BB5NNNC
+CODE_OFFSETS = {'GRM': 5, 'GJM': 5, 'GQM': 5, 'C': 5, 'CL': 1}
+VALUE = re.compile(r'(\d+(?:[.,]\d+)?)\s*(ph|nh|uh|µh|ff|pf|nf|uf|µf)(?![a-z])', re.IGNORECASE)
+N_NOTATION = re.compile(r'(?<![0-9])(\d+)N(\d*)') # inductor codes as in LQW15AN1N5 (1.5 nH), LQW15AN10N (10 nH)
+EIA_CODE = re.compile(r'(\d?)R(\d\d?)|(\d\d)(\d)') # capacitance codes in pF: 1R0 (1.0), R50 (0.5), 100 (10), 101 (100)
+SIZE = re.compile(r'(?<!\d)(0201|0402|0603|0805|1206)(?!\d)')
+
+
+class ComponentIndex():
+    '''
+    metadata of the Touchstone files of a component library, taken from the file names and header
+    comments only (the S-parameters are not read):
+    - kind: 'L' / 'C' (unit of the value, part number or the name of the directory)
+    - value: nominal value in H / F, vendor, series (product series, e.g. LQW15), size (imperial case code)
+    - type: CompType name of the file as passed to update()
+    select() filters the entries, only the selected files have to be loaded
+    path: optional json file, the index is kept there and only changed files (size, mtime) are scanned again
+    '''
+    def __init__(self, path = None):
+        self.path = path
+        self.entries = {} # file path -> entry
+        if path and os.path.exists(path):
+            with open(path) as f:
+                data = json.load(f)
+            if data.get('version') == INDEX_VERSION:
+                self.entries = data['entries']
+
+
+    def __len__(self):
+        return len(self.entries)
+
+
+    def __iter__(self):
+        return iter(self.entries.values())
+
+
+    def update(self, files):
+        '''
+        files: [(path, type name)], e.g. MatchingNetworkLibrary._list_component_files()
+        scans the new and changed files, forgets the missing ones, returns the entries in the order of files
+        '''
+        entries = {}
+        scanned = 0
+        for (path, type_name) in files:
+            stat = os.stat(path)
+            entry = self.entries.get(path)
+            if entry is None or entry['size_bytes'] != stat.st_size or entry['mtime_ns'] != stat.st_mtime_ns:
+                entry = scan_file(path)
+                entry.update(size_bytes=stat.st_size, mtime_ns=stat.st_mtime_ns)
+                scanned += 1
+            entry['type'] = type_name
+            entries[path] = entry
+        changed = scanned > 0 or len(entries) != len(self.entries)
+        self.entries = entries
+        if changed:
+            logging.info('component index: scanned %d of %d files' % (scanned, len(entries)))
+            self.save()
+        return list(entries.values())
+
+
+    def save(self):
+        if not self.path:
+            return
+        temp_path = self.path + '.tmp'
+        with open(temp_path, 'w') as f:
+            json.dump({'version': INDEX_VERSION, 'entries': self.entries}, f)
+        os.replace(temp_path, self.path)
+
+
+    def select(self, kind = None, vendor = None, series = None, size = None, min_value = None, max_value = None,
+               types = None, name = None):
+        '''
+        entries that match all given criteria (case insensitive), e.g. 0402 inductors 1-30 nH:
+        select(kind='L', size='0402', min_value=1e-9, max_value=30e-9)
+        series: prefix of the product series, name: regular expression on the file name, types: CompType names
+        parts without a known value never match a value range
+        '''
+        result = []
+        for entry in self.entries.values():
+            if kind is not None and (entry['kind'] or '').upper() != kind.upper():
+                continue
+            if vendor is not None and (entry['vendor'] or '').lower() != vendor.lower():
+                continue
+            if series is not None and not (entry['series'] or '').upper().startswith(series.upper()):
+                continue
+            if size is not None and entry['size'] != size:
+                continue
+            if types is not None and entry['type'] not in types:
+                continue
+            if name is not None and not re.search(name, entry['name'], re.IGNORECASE):
+                continue
+            if min_value is not None or max_value is not None:
+                value = entry['value']
+                if value is None:
+                    continue
+                if min_value is not None and value < min_value * (1 - 1e-9):
+                    continue
+                if max_value is not None and value > max_value * (1 + 1e-9):
+                    continue
+            result.append(entry)
+        return result
+
+
+def read_header(path):
+    # comment lines of a Touchstone file up to the option line (# ...)
+    comments = []
+    with open(path, errors='replace') as f:
+        for (number, line) in enumerate(f):
+            line = line.strip()
+            if number >= HEADER_LINES or (line and not line.startswith('!')):
+                break
+            if line:
+                comments.append(line[1:].strip())
+    return comments
+
+
+def _decode_capacitance(name, start):
+    # EIA code at name[start:], the third digit is the number of zeros (8 / 9: x0.01 / x0.1)
+    match = EIA_CODE.match(name, start)
+    if match is None:
+        return None
+    if match.group(2):
+        return float((match.group(1) or '0') + '.' + match.group(2)) * 1e-12
+    exponent = int(match.group(4))
+    exponent = exponent - 10 if exponent >= 8 else exponent
+    return int(match.group(3)) * 10.0 ** exponent * 1e-12
+
+
+def scan_file(path):
+    name = os.path.splitext(os.path.basename(path))[0]
+    directory = os.path.basename(os.path.dirname(path))
+    header = ' '.join(read_header(path))
+    entry = {'path': path, 'name': name, 'kind': None, 'value': None, 'vendor': None, 'series': None, 'size': None}
+    code_start = None
+
+    for (pattern, vendor, kind, sizes) in PART_NUMBERS:
+        match = re.match(pattern, name.upper())
+        if match:
+            entry.update(vendor=vendor, kind=kind, series=''.join(match.groups()))
+            entry['size'] = sizes.get(match.group(2)) if sizes else match.group(2)
+            if match.group(1) in CODE_OFFSETS:
+                code_start = match.end() + CODE_OFFSETS[match.group(1)]
+            break
+
+    lower_header = header.lower()
+    for (keyword, vendor) in VENDORS.items():
+        if keyword in lower_header:
+            entry['vendor'] = vendor
+            break
+
+    for text in (header, name):
+        match = VALUE.search(text)
+        if match:
+            unit = match.group(2).lower()
+            entry['value'] = float(match.group(1).replace(',', '.')) * UNITS[unit]
+            entry['kind'] = 'L' if unit.endswith('h') else 'C'
+            break
+    if entry['value'] is None and entry['kind'] == 'L':
+        match = N_NOTATION.search(name.upper()[len(entry['series'] or ''):])
+        if match:
+            entry['value'] = float(match.group(1) + '.' + (match.group(2) or '0')) * 1e-9
+    if entry['value'] is None and code_start is not None:
+        entry['value'] = _decode_capacitance(name.upper(), code_start)
+
+    if entry['kind'] is None:
+        entry['kind'] = _get_kind(directory, lower_header)
+    if entry['size'] is None:
+        match = SIZE.search(header) or SIZE.search(name)
+        entry['size'] = match.group(1) if match else None
+    return entry
+
+
+# 'L' / 'C' from the directory name (e.g. L, series_C, inductors) or the header, None if unknown
+def _get_kind(directory, lower_header):
+    tokens = re.split(r'[^a-z]+', directory.lower())
+    if 'l' in tokens or any(token.startswith('ind') for token in tokens):
+        return 'L'
+    if 'c' in tokens or any(token.startswith('cap') for token in tokens):
+        return 'C'
+    if 'inductor' in lower_header:
+        return 'L'
+    if 'capacitor' in lower_header:
+        return 'C'
+    return None
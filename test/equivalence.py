@@ -0,0 +1,41 @@
+import numpy as np
+from scipy.spatial import cKDTree
+
+
+def abcd_to_s(abcd, z0):
+    # S-parameters [..., n_freq, 2, 2] of the two-ports abcd [..., n_freq, 2, 2] (real reference impedance z0)
+    (a, b, c, d) = (abcd[..., 0, 0], abcd[..., 0, 1], abcd[..., 1, 0], abcd[..., 1, 1])
+    denominator = a + b / z0 + c * z0 + d
+    s = np.empty(abcd.shape, dtype=complex)
+    s[..., 0, 0] = (a + b / z0 - c * z0 - d) / denominator
+    s[..., 0, 1] = 2 * (a * d - b * c) / denominator
+    s[..., 1, 0] = 2 / denominator
+    s[..., 1, 1] = (-a + b / z0 - c * z0 + d) / denominator
+    return s
+
+
+def get_equivalence_classes(s, tolerance, samples = 16):
+    '''
+    groups parts with (nearly) the same S-parameters s [n, n_freq, 2, 2]:
+    every part joins the class of the first part whose S-parameters differ by at most tolerance
+    (max. magnitude over all entries and points), the first member is the representative
+    a kd-tree over a few sample points (max. norm, real and imaginary parts) gives the candidates,
+    they are then checked at all points
+    returns the index of the representative of every part [n]
+    '''
+    n = len(s)
+    flat = np.asarray(s).reshape(n, s.shape[1], -1)
+    points = np.unique(np.linspace(0, s.shape[1] - 1, samples).astype(int))
+    sample = flat[:, points].reshape(n, -1)
+    sample = np.concatenate([sample.real, sample.imag], axis=1)
+    tree = cKDTree(sample)
+    representatives = np.full(n, -1, dtype=np.intp)
+    for k in range(n):
+        if representatives[k] >= 0:
+            continue
+        candidates = np.array(tree.query_ball_point(sample[k], tolerance, p=np.inf), dtype=np.intp)
+        candidates = candidates[representatives[candidates] < 0]
+        close = np.abs(flat[candidates] - flat[k]).max(axis=(1, 2)) <= tolerance
+        representatives[candidates[close]] = k
+        representatives[k] = k
+    return representatives
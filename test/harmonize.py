@@ -0,0 +1,60 @@
+import skrf as rf
+import numpy as np
+from scipy.interpolate import interp1d
+
+
+# one pass replacement for the pairwise rf.network.overlap() of all component combinations:
+# the common band is computed once from all grids, then every network is resampled exactly once,
+# networks with the same grid are stacked and interpolated together (linear in re/im like Network.interpolate())
+
+
+def get_common_frequency(frequencies, target = None):
+    '''
+    frequencies: [rf.Frequency] of all networks
+    target: optional rf.Frequency, default: the densest grid
+    returns the points of target that lie inside the band covered by all networks
+    '''
+    f_start = max(frequency.start for frequency in frequencies)
+    f_stop = min(frequency.stop for frequency in frequencies)
+    if f_start > f_stop:
+        raise ValueError('the networks have no common frequency range')
+    if target is None:
+        target = max(frequencies, key=lambda frequency: np.count_nonzero(_get_band_mask(frequency.f, f_start, f_stop)))
+    f = target.f[_get_band_mask(target.f, f_start, f_stop)]
+    if len(f) < 2:
+        raise ValueError('less than 2 frequency points in the common range %g-%g Hz' % (f_start, f_stop))
+    frequency = rf.Frequency.from_f(f, unit='hz')
+    frequency.unit = target.unit
+    return frequency
+
+
+def resample(networks, frequency):
+    '''
+    returns new networks on frequency (the input networks are not modified)
+    '''
+    groups = {} # (grid, number of ports) -> [position]
+    for (position, network) in enumerate(networks):
+        key = (network.frequency.f.tobytes(), network.nports)
+        groups.setdefault(key, []).append(position)
+
+    result = [None] * len(networks)
+    for positions in groups.values():
+        source = networks[positions[0]].frequency.f
+        s = np.stack([networks[position].s for position in positions])
+        z0 = np.stack([networks[position].z0 for position in positions])
+        if not np.array_equal(source, frequency.f):
+            s = interp1d(source, s, axis=1)(frequency.f)
+            z0 = interp1d(source, z0, axis=1)(frequency.f)
+        for (k, position) in enumerate(positions):
+            result[position] = rf.Network(frequency=frequency, s=s[k], z0=z0[k], name=networks[position].name)
+    return result
+
+
+def harmonize(networks, target = None):
+    # returns (common frequency, [resampled network])
+    frequency = get_common_frequency([network.frequency for network in networks], target)
+    return (frequency, resample(networks, frequency))
+
+
+def _get_band_mask(f, f_start, f_stop):
+    return (f >= f_start) & (f <= f_stop)
@@ -0,0 +1,86 @@
+import os
+import json
+import shutil
+import hashlib
+import numpy as np
+import skrf as rf
+from cascade import save_matrices, load_matrices
+
+CACHE_VERSION = 1 # bump when the layout of an entry changes
+
+
+class LibraryCache():
+    '''
+    on-disk cache of harmonized component libraries, one directory per key:
+    - s.npy, z0.npy: S-parameters / port impedances on the common grid [n_components, n_freq, 2, 2] / [..., 2]
+    - abcd.npy: the CascadeEngine matrices (see save_matrices())
+    - f.npy: the common frequency grid in Hz
+    - components.json: names, types, frequency unit
+    the key hashes the component files (path, size, mtime), the dut grid, the target grid and z0,
+    so touching a file or changing the grid simply misses the cache
+    the arrays are loaded as read-only memmaps, processes using the same entry share the pages
+    '''
+    def __init__(self, path = 'cache'):
+        self.path = path
+        os.makedirs(path, exist_ok=True)
+
+
+    def get_key(self, files, dut_frequency = None, target = None, z0 = 50):
+        '''
+        files: [(path, type name)] of all component files
+        dut_frequency: frequency of the dut or a list of them (multi dut sweeps)
+        '''
+        key = hashlib.sha256()
+        key.update(('%d %r' % (CACHE_VERSION, z0)).encode())
+        for (path, type_name) in files:
+            stat = os.stat(path)
+            key.update(('%s %s %d %d\n' % (path, type_name, stat.st_size, stat.st_mtime_ns)).encode())
+        dut_frequencies = dut_frequency if isinstance(dut_frequency, (list, tuple)) else [dut_frequency]
+        for frequency in dut_frequencies + [target]:
+            key.update(b'-' if frequency is None else np.asarray(frequency.f, dtype=np.float64).tobytes())
+        return key.hexdigest()
+
+
+    def _get_entry_path(self, key):
+        return os.path.join(self.path, key)
+
+
+    def load(self, key):
+        '''
+        returns None on a miss, else a dict with frequency, names, types, s, z0, abcd
+        '''
+        entry = self._get_entry_path(key)
+        if not os.path.exists(os.path.join(entry, 'components.json')):
+            return None
+        with open(os.path.join(entry, 'components.json')) as f:
+            meta = json.load(f)
+        frequency = rf.Frequency.from_f(np.load(os.path.join(entry, 'f.npy')), unit='hz')
+        frequency.unit = meta['unit']
+        entry_data = {'frequency': frequency, 'names': meta['names'], 'types': meta['types']}
+        for name in ('s', 'z0'):
+            entry_data[name] = np.load(os.path.join(entry, name + '.npy'), mmap_mode='r')
+        entry_data['abcd'] = load_matrices(os.path.join(entry, 'abcd.npy'))
+        return entry_data
+
+
+    def store(self, key, frequency, names, types, s, z0, abcd):
+        # written to a temporary directory first, a complete entry appears atomically
+        entry = self._get_entry_path(key)
+        temp = entry + '.%d.tmp' % os.getpid()
+        shutil.rmtree(temp, ignore_errors=True)
+        os.makedirs(temp)
+        np.save(os.path.join(temp, 'f.npy'), np.asarray(frequency.f, dtype=np.float64))
+        np.save(os.path.join(temp, 's.npy'), np.asarray(s, dtype=complex))
+        np.save(os.path.join(temp, 'z0.npy'), np.asarray(z0, dtype=complex))
+        save_matrices(os.path.join(temp, 'abcd.npy'), abcd)
+        with open(os.path.join(temp, 'components.json'), 'w') as f:
+            json.dump({'unit': frequency.unit, 'names': list(names), 'types': list(types)}, f)
+        try:
+            os.replace(temp, entry)
+        except OSError: # another process stored the same entry in the meantime
+            shutil.rmtree(temp, ignore_errors=True)
+
+
+    def clear(self):
+        for name in os.listdir(self.path):
+            shutil.rmtree(os.path.join(self.path, name), ignore_errors=True)
@@ -11,12 +11,16 @@ from matchingsim import *
 import winsound
 
 short = rf.data.wr2p2_short
+# opt-in, e.g. 8: screen on every 8th band point first (faster, the margin only approximates the full grid
+# for min_db limits, rejected variations are stored with nan scores)
+COARSE_STEP = None
 rf.stylely()
 
-csvdata = []
-
-class MyEvaluator(Evaluator):
+class MyEvaluator(BandEvaluator):
     def __init__(self):
+        # score: max and min S11 in dB, feasible: min < -7 dB and max < -3 dB
+        BandEvaluator.__init__(self, ['1700mhz-1900mhz'], metrics=['max_db', 'min_db'],
+                               limits=[(0, 'min_db', -7), (0, 'max_db', -3)])
         self.best_max = 0
 
     def evaluate(self, data):
@@ -30,16 +34,7 @@ class MyEvaluator(Evaluator):
 
         (i, network, variation) = data
 
-        f_2_l = '1700mhz'
-        f_2_h = '1900mhz'
-        range_2 = f_2_l + '-' + f_2_h
-
-        s11_2 = rf.mathFunctions.complex_2_db(network[range_2].s11.s)
-
-        maxdb_2 = max(s11_2)
-        mindb_2 = min(s11_2)
-
-        csvdata.append((i, maxdb_2, mindb_2))
+        (maxdb_2, mindb_2) = self.score([i], network.s[None, :, 0, 0], network.frequency)[0]
 
         #print(i)
 
@@ -67,7 +62,7 @@ def plot_results(final_res, results):
     save_all_figs('./plots_best', format=['pdf'])
 
     for result in results:
-        (i, network, variation) = data
+        (i, network, variation) = result
         network.plot_s_db(label=str(i))
 
     save_all_figs('./plots', format=['pdf'])
@@ -95,17 +90,23 @@ def main():
 
     network_description = [CompKey.SERIES, CompKey.SHUNT, CompKey.SERIES, CompKey.SHUNT]
 
-    simManager = MatchingSimulationManager(antenna, evaluator, network_description)
+    shortlist = TopKCollector(10) # lowest max S11 in the band
+    simManager = MatchingSimulationManager(antenna, evaluator, network_description, result_store=ResultStore('results'),
+                                           collectors=[shortlist], cache=LibraryCache('cache'),
+                                           metrics_path='metrics.json', yield_analysis=YieldAnalysis(1000),
+                                           coarse_step=COARSE_STEP)
 
     start = time.time()
     (final_result, feasible_results) = simManager.simulate()
     end = time.time()
 
+    # streamed from the (memory mapped) result store
+    numbers = simManager.result_store.column('number')
+    scores = simManager.result_store.column('score')
     with open(r'test.csv', 'w') as f:
         writer = csv.writer(f)
         writer.writerow(['i', 'max', 'min'])
-        for dat in csvdata:
-            (i, max, min) = dat
+        for (i, (max, min)) in zip(numbers, scores):
             writer.writerow([i, max, min])
 
     if not final_result:
@@ -115,7 +116,9 @@ def main():
     print_simulation_result(final_result, end - start)
     (i, network, variation) = final_result
 
-    plot_results(final_result, feasible_results)
+    # only the best few networks are rebuilt for plotting
+    top_results = [simManager.get_result(i) for (i, max) in shortlist.results()]
+    plot_results(final_result, top_results)
 
     winsound.PlaySound("SystemExclamation", winsound.SND_ALIAS)
 
@@ -2,19 +2,45 @@ import skrf as rf
 from skrf.data import ring_slot
 from skrf.plotting import save_all_figs
 from skrf.data import wr2p2_short as short
-from itertools import islice, product, zip_longest, combinations, repeat
+from itertools import islice, product, zip_longest, repeat
+from collections import deque
 import matplotlib.pyplot as plt
 import logging
 import os
+import glob
 from enum import Enum
 import time
 from pprint import pprint
+import pickle
+import hashlib
+import copy
 import concurrent.futures
 from multiprocessing import Pool
 import concurrent.futures
 from more_itertools import ichunked
+import numpy as np
+from cascade import CascadeEngine
+from variationspace import VariationSpace
+from resultstore import ResultStore
+from collectors import TopKCollector, ParetoCollector
+from bands import BandSpec, ReflectionBound
+from harmonize import harmonize, resample
+from librarycache import LibraryCache
+from partindex import PartIndex
+from smithindex import SmithIndex
+from pipeline import Pipeline, Stage
+from metrics import Metrics
+from equivalence import abcd_to_s, get_equivalence_classes
+from yieldanalysis import YieldAnalysis
+from componentindex import ComponentIndex
+from coarse import CoarseScreen
+from array import array
 
 USE_MULTIPROCESSING = True
+Z_0 = 50
+SHARD_SIZE = 2 ** 14 # max. number of variations per task of the process pool
+PIPELINE_WORKERS = {'build': 2, 'cascade': 1, 'score': 1} # threads per stage of the pipelined sweep
+PIPELINE_QUEUE_SIZE = 4 # batches waiting between two stages
 
 class CompKey(Enum):
     SERIES = 1
@@ -43,6 +69,32 @@ class Evaluator():
         i, network, variation = data
         return data
 
+    def screen(self, indices, s11, frequency):
+        '''
+        optional vectorized pre-selection, only used by the batched engine
+        indices: variation numbers of the batch
+        s11: reflection coefficients of the terminated networks [batch, n_freq]
+        return a boolean mask, only the selected candidates are turned into
+        networks and passed on to evaluate()
+        '''
+        return np.ones(len(indices), dtype=bool)
+
+    def score(self, indices, s11, frequency):
+        '''
+        optional vectorized figure of merit for every candidate of a batch,
+        [batch] or [batch, n] floats, ends up in MatchingSimulationManager.result_store (if there is one)
+        (this is all that comes back from the worker processes besides screen())
+        '''
+        return np.zeros(len(indices))
+
+    def get_bound(self, frequency):
+        '''
+        optional branch and bound test for MatchingSimulationManager(branch_and_bound=True),
+        an object with prune(lower_bound) -> True if no candidate with |S11| >= lower_bound [n_freq]
+        can pass screen(), see ReflectionBound
+        '''
+        return None
+
     def get_result_str(self, data):
         return 'please implement the get_result_str() function in your Evaluator'
 
@@ -51,13 +103,140 @@ class Evaluator():
         logging.info('===================')
 
 
+class BandEvaluator(Evaluator):
+    '''
+    evaluator for band criteria on S11, the bands are compiled once against the frequency grid (see BandSpec)
+    bands: e.g. ['791mhz-861mhz', '1710mhz-1880mhz']
+    metrics: BandSpec metric names, score() returns them for every band [batch, n_bands * n_metrics]
+    limits: [(band number, metric name, upper limit)], feasible if every metric is below its limit
+    '''
+    def __init__(self, bands, metrics = ('max_db',), limits = ()):
+        self.bands = bands
+        self.metrics = list(metrics)
+        self.limits = list(limits)
+        self.band_spec = None
+
+    def get_band_spec(self, frequency):
+        if self.band_spec is None or not self.band_spec.matches(frequency):
+            self.band_spec = BandSpec(self.bands, frequency)
+        return self.band_spec
+
+    def score(self, indices, s11, frequency):
+        return self.get_band_spec(frequency).metrics(s11, self.metrics)
+
+    def screen(self, indices, s11, frequency):
+        band_spec = self.get_band_spec(frequency)
+        mask = np.ones(len(indices), dtype=bool)
+        for (band, name, limit) in self.limits:
+            mask &= band_spec.metric(s11, name, band) < limit
+        return mask
+
+    def get_bound(self, frequency):
+        if not self.limits:
+            return None
+        return ReflectionBound(self.get_band_spec(frequency), self.limits)
+
+    def evaluate(self, data):
+        (i, network, variation) = data
+        if self.screen([i], network.s[None, :, 0, 0], network.frequency)[0]:
+            return data
+        return None
+
+
+class StateEvaluator(Evaluator):
+    '''
+    screen() / score() of an evaluator for s11 [batch, n_states, n_freq] of a multi dut sweep:
+    every state is passed to the evaluator as a candidate of its own, a variation is feasible if it passes
+    in all states, the score is the worst case over the states (weights None) or the weighted mean
+    evaluate() and the rest are the ones of the evaluator (the candidates get the network of the first state)
+    '''
+    def __init__(self, evaluator, weights = None):
+        self.evaluator = evaluator
+        self.weights = None if weights is None else np.asarray(weights, dtype=float)
+
+    def _flatten(self, indices, s11):
+        (batch, states) = s11.shape[:2]
+        return (np.repeat(np.asarray(indices), states), s11.reshape(batch * states, s11.shape[-1]))
+
+    def screen(self, indices, s11, frequency):
+        mask = np.asarray(self.evaluator.screen(*self._flatten(indices, s11), frequency), dtype=bool)
+        return mask.reshape(s11.shape[:2]).all(axis=1)
+
+    def score(self, indices, s11, frequency):
+        scores = np.asarray(self.evaluator.score(*self._flatten(indices, s11), frequency), dtype=float)
+        scores = scores.reshape(s11.shape[:2] + scores.shape[1:])
+        if self.weights is None:
+            return scores.max(axis=1)
+        return np.average(scores, axis=1, weights=self.weights)
+
+    def get_bound(self, frequency):
+        return self.evaluator.get_bound(frequency)
+
+    def evaluate(self, data):
+        return self.evaluator.evaluate(data)
+
+    def get_result_str(self, data):
+        return self.evaluator.get_result_str(data)
+
+
 class MatchingSimulationManager():
-    def __init__(self, dut, evaluator, network_description):
-        self.network_library = MatchingNetworkLibrary()
+    def __init__(self, dut, evaluator, network_description, batch_size = 256, prefix_sharing = False, processes = None,
+                 checkpoint_path = None, checkpoint_interval = 60, result_store = None, collectors = (),
+                 branch_and_bound = False, frequency = None, cache = None, series_dir = None, shunt_dir = None,
+                 meet_in_the_middle = False, pipeline = False, pipeline_workers = None, metrics_path = None,
+                 equivalence_tolerance = None, yield_analysis = None, dut_weights = None, part_filter = None,
+                 index_path = None, coarse_step = None, coarse_margin_db = 1.0, library = None, pool = None):
+        # cache: optional LibraryCache for warm starts, series_dir/shunt_dir default to components/series|shunt
+        # equivalence_tolerance: only sweep one part of every group of (nearly) identical parts, see get_equivalent_variations()
+        # part_filter: ComponentIndex.select() criteria, only the matching files are loaded (index_path: keeps the scan)
+        # dut: a Network or a list of them (states of the same antenna, e.g. free space / hand), every network is
+        # cascaded once and terminated into all states, see StateEvaluator (dut_weights: weighted mean instead of worst case)
+        # coarse_step: screen every batch on every coarse_step-th point of the limited bands first and only cascade
+        # the survivors on the full grid, see CoarseScreen (coarse_margin_db: allowance of the min_db / mean_db tests)
+        # library: an initialized MatchingNetworkLibrary to fork instead of reading the components (frequency, cache,
+        # series_dir, shunt_dir, part_filter and index_path are the ones of that library then), see SweepService
+        # pool: runs the shards of the parallel sweep instead of an own Pool of processes, pool.imap(worker_args, tasks)
+        # yields (task, _run_worker(task)) in the order of tasks after _init_worker(*worker_args), see SweepService
+        if library is None:
+            self.network_library = MatchingNetworkLibrary(series_dir, shunt_dir, cache, part_filter, index_path)
+            self.network_library.init_network_variations(network_description, dut, frequency, # frequency: optional target grid
+                                                         equivalence_tolerance)
+        else:
+            self.network_library = library.fork(dut)
+            self.network_library.init_variations(network_description, equivalence_tolerance)
         self.evaluator = evaluator
-        self.dut = dut
-        self.network_library.init_network_variations(network_description, dut)
-        self.dut.interpolate_self(self.network_library.frequency)
+        self.batch_size = batch_size # None -> old per-variation Network ** Network path
+        self.prefix_sharing = prefix_sharing # depth first evaluation with cached partial cascades
+        self.branch_and_bound = branch_and_bound # skip subtrees that can't pass Evaluator.screen() (Evaluator.get_bound())
+        self.meet_in_the_middle = meet_in_the_middle # only cascade what the SmithIndex can't rule out (single process)
+        self.pipeline = pipeline # staged sweep in threads instead of processes (see _simulate_pipelined())
+        self.pipeline_workers = dict(PIPELINE_WORKERS, **(pipeline_workers or {}))
+        self.pipeline_stats = None # Pipeline.get_stats() of the last pipelined run
+        self.metrics = Metrics() # timers, rate and eta of the last simulate() (see Metrics)
+        self.metrics_path = metrics_path # None -> no export, *.csv -> Metrics.write_csv(), else write_json()
+        self.yield_analysis = yield_analysis # YieldAnalysis of the collector results after every simulate()
+        self.yield_results = None # YieldAnalysis.run() of the last simulate()
+        self.coarse_step = coarse_step
+        self.coarse_margin_db = coarse_margin_db
+        self.coarse = None # CoarseScreen of the current simulate()
+        if processes is None:
+            processes = os.cpu_count() if USE_MULTIPROCESSING else 1
+        self.processes = processes
+        self.pool = pool
+        self.result_store = result_store # ResultStore for the records of every variation (batched modes), None -> no records
+        self.collectors = list(collectors) # e.g. TopKCollector, ParetoCollector (batched modes)
+        self.checkpoint_path = checkpoint_path # None -> no checkpoints
+        self.checkpoint_interval = checkpoint_interval # seconds
+        self._last_checkpoint = None
+        self.network_description = network_description
+        self.dut = self.network_library.dut # the first state
+        self.duts = self.network_library.duts
+        if len(self.duts) > 1:
+            self.gamma_load = np.stack([dut.s[:, 0, 0] for dut in self.duts]) # [n_states, n_freq]
+            self.scorer = StateEvaluator(evaluator, dut_weights)
+        else:
+            self.gamma_load = self.dut.s[:, 0, 0]
+            self.scorer = evaluator # screen() + score() of the batches
 
 
     def sim_thread(self, i, network, variation):
@@ -80,99 +259,606 @@ class MatchingSimulationManager():
         return (i, result_network, variation)
 
 
-    def simulate(self):
-        i = 0
+    def simulate(self, resume_from = None):
+        '''
+        resume_from: checkpoint file written by an earlier (interrupted) run,
+        the sweep continues after the last completed variation
+        (an in-memory result store then only contains the variations of this run)
+        returns (last result accepted by the evaluator, FeasibleResults)
+        '''
+        state = (0, None, FeasibleResults(self))
+        if resume_from:
+            state = self._load_checkpoint(resume_from)
+            if self.result_store is not None:
+                self.result_store.truncate(state[0])
+            logging.info('resuming at variation ' + str(state[0]))
+        else:
+            if self.result_store is not None:
+                self.result_store.clear()
+            for collector in self.collectors:
+                collector.clear()
+        self._last_checkpoint = time.time()
+        if not self.batch_size and len(self.duts) > 1:
+            logging.warning('the network path only simulates the first dut state')
+        self.metrics.start(len(self.network_library.variation_space), state[0])
+        self.coarse = self._get_coarse_screen()
+        try:
+            if not self.batch_size:
+                result = self._simulate_networks(*state)
+            elif self.meet_in_the_middle:
+                result = self._simulate_meet_in_the_middle(*state)
+            elif self.pipeline:
+                result = self._simulate_pipelined(*state)
+            elif self.processes > 1 or self.pool is not None:
+                result = self._simulate_parallel(*state)
+            else:
+                result = self._simulate_batched(*state)
+            if self.yield_analysis is not None:
+                self.yield_results = self.analyze_yield(self.get_shortlist())
+            return result
+        finally:
+            self.metrics.finish()
+            self.metrics.log()
+            if self.metrics_path:
+                self.write_metrics(self.metrics_path)
+
+
+    def write_metrics(self, path):
+        if path.endswith('.csv'):
+            self.metrics.write_csv(path)
+        else:
+            self.metrics.write_json(path)
+
+
+    def _checkpoint(self, next_number, simulation_result, all_feasible_results, force = False):
+        # stores the number of the next variation, the evaluator state and the feasible results (as variation numbers)
+        if not self.checkpoint_path:
+            return
+        if not force and time.time() - self._last_checkpoint < self.checkpoint_interval:
+            return
+        if self.result_store is not None:
+            self.result_store.flush()
+        checkpoint = {
+            'next_number': next_number,
+            'number_of_variations': len(self.network_library.variation_space),
+            'network_description': [key.name for key in self.network_description],
+            'library_hash': self._get_library_hash(),
+            'evaluator_state': self.evaluator.__dict__,
+            'feasible_numbers': all_feasible_results.numbers, # array('q'), pickled as raw bytes
+            'result_number': None if simulation_result is None else simulation_result[0],
+            'collectors': self.collectors,
+        }
+        temp_path = self.checkpoint_path + '.tmp'
+        with open(temp_path, 'wb') as f:
+            pickle.dump(checkpoint, f)
+        os.replace(temp_path, self.checkpoint_path) # never leaves a half written checkpoint behind
+        self._last_checkpoint = time.time()
+
+
+    def _get_library_hash(self):
+        # the variation numbers depend on the components (and their order), not only on their number
+        key = hashlib.sha256()
+        for component in self.network_library.components:
+            key.update((component.type.name + '/' + component.name + '\n').encode())
+        return key.hexdigest()
+
+
+    def _load_checkpoint(self, path):
+        with open(path, 'rb') as f:
+            checkpoint = pickle.load(f)
+        if (checkpoint['number_of_variations'] != len(self.network_library.variation_space)
+                or checkpoint['network_description'] != [key.name for key in self.network_description]
+                or checkpoint.get('library_hash') != self._get_library_hash()):
+            raise ValueError('checkpoint ' + path + ' belongs to a different network description or component library')
+
+        self.evaluator.__dict__.update(checkpoint['evaluator_state'])
+        for (collector, saved_collector) in zip(self.collectors, checkpoint['collectors']):
+            collector.clear()
+            collector.merge(saved_collector)
+        all_feasible_results = FeasibleResults(self, checkpoint['feasible_numbers'])
         simulation_result = None
-        all_feasible_results = []
-        for (network, variation) in self.network_library:
+        if checkpoint['result_number'] is not None:
+            simulation_result = self.get_result(checkpoint['result_number'])
+        return (checkpoint['next_number'], simulation_result, all_feasible_results)
+
+
+    def get_result(self, i):
+        # rebuilds (i, network, variation) of variation i, as passed to evaluate()
+        library = self.network_library
+        variation = library.variation_space[i]
+        s11 = library.engine.evaluate([[component.index for component in variation]], self.dut.s[:, 0, 0])[0]
+        return (i, library.engine.to_network(s11, name=str(i)), variation)
+
+
+    def get_shortlist(self):
+        # variation numbers of all collector results (ascending)
+        numbers = set()
+        for collector in self.collectors:
+            numbers.update(number for (number, score) in collector.results())
+        return sorted(numbers)
+
+
+    def analyze_yield(self, numbers, yield_analysis = None):
+        '''
+        monte carlo tolerance analysis of the given variations against Evaluator.screen()
+        yield_analysis: default self.yield_analysis or YieldAnalysis() with the default tolerances
+        returns YieldAnalysis.run()
+        '''
+        yield_analysis = yield_analysis or self.yield_analysis or YieldAnalysis()
+        with self.metrics.timer('yield', len(numbers) * yield_analysis.samples):
+            results = yield_analysis.run(self.network_library, self.scorer, self.gamma_load, numbers)
+        for result in results:
+            logging.info('yield of variation %d: %.1f %% (%d of %d samples)' % (
+                result['number'], result['pass_rate'] * 100, result['passed'], result['samples']))
+        return results
+
+
+    def get_equivalent_variations(self, i):
+        # all variations that only differ from variation i in parts of the same equivalence class (including itself)
+        return self.network_library.expand(self.network_library.variation_space[i])
+
+
+    def evaluate_variations(self, numbers):
+        '''
+        evaluates only the given variations instead of the whole space
+        (e.g. the neighborhood of a continuous optimum, see PartIndex)
+        returns (numbers, Evaluator.score(), Evaluator.screen()) in the order of numbers
+        '''
+        library = self.network_library
+        batch_size = self.batch_size or 256
+        numbers = np.asarray(numbers, dtype=np.int64)
+        scores = []
+        feasible = []
+        for first in range(0, len(numbers), batch_size):
+            batch = numbers[first:first + batch_size]
+            indices = np.array([[component.index for component in library.variation_space[int(i)]] for i in batch], dtype=np.intp)
+            (mask, batch_scores) = self._score_batch(batch, self._cascade(self._build(indices)))
+            feasible.append(mask)
+            scores.append(batch_scores)
+        if not scores:
+            return (numbers, np.zeros(0), np.zeros(0, dtype=bool))
+        return (numbers, np.concatenate(scores), np.concatenate(feasible))
+
+
+    def _simulate_networks(self, start, simulation_result, all_feasible_results):
+        i = start
+        metrics = self.metrics
+        self.network_library.seek(start)
+        for (network, variation) in metrics.iter_timed('build', self.network_library, size=lambda item: 1):
             #network = circuit.network # BOTTLENECK!
             data = (i, network, variation)
-            res_data = self.sim_thread(i, network, variation)
-            ev_result = self.evaluator.evaluate(res_data)
+            with metrics.timer('cascade'):
+                res_data = self.sim_thread(i, network, variation)
+            with metrics.timer('evaluate'):
+                ev_result = self.evaluator.evaluate(res_data)
             if ev_result != None:
                 self.evaluator.print_result(ev_result)
                 simulation_result = ev_result
                 all_feasible_results.append(simulation_result)
 
-            if i % 100 == 0:
-                logging.info('progress: ' + str(i))
             i += 1
+            metrics.progress(i)
+            self._checkpoint(i, simulation_result, all_feasible_results)
 
+        self._checkpoint(i, simulation_result, all_feasible_results, force=True)
         return (simulation_result, all_feasible_results)
 
 
-class ComponentPoolEntry():
-    def __init__(self, networks = None):
-        if networks is None:
-            self.networks = []
+    def _iter_evaluated_batches(self, start):
+        # yields (number of the first variation, [variation], component indices [batch, depth], s11, rows)
+        # s11 [batch, n_freq] (rows None) or only of the rows that survived the coarse screen
+        library = self.network_library
+        coarse = self.coarse
+        if (self.prefix_sharing or self.branch_and_bound) and coarse is None:
+            # build + cascade in one go, the partial cascades are shared
+            batches = library.iter_prefix_batches(self.gamma_load, self.batch_size, start, bound=self._get_bound())
+            for batch in self.metrics.iter_timed('cascade', batches, size=lambda batch: len(batch[1])):
+                yield batch + (None,)
+            return
+        if self.prefix_sharing or self.branch_and_bound:
+            # the shared partial cascades on the coarse points, the coarse screen is the (stricter) bound
+            batches = library.iter_prefix_batches(coarse.get_gamma_load(self.gamma_load), self.batch_size, start,
+                                                  bound=coarse if self.branch_and_bound else None, engine=coarse.engine)
+            for (start, variations, indices, coarse_s11) in self.metrics.iter_timed('coarse', batches, size=lambda batch: len(batch[1])):
+                yield (start, variations, indices) + self._refine(indices, coarse_s11)
+            return
+        library.seek(start)
+        for (start, variations, indices) in library.iter_batches(self.batch_size, start):
+            yield (start, variations, indices) + self._evaluate_batch(indices)
+
+
+    def _build(self, indices):
+        # ABCD matrices of the networks of a batch
+        with self.metrics.timer('build', len(indices)):
+            return self.network_library.engine.cascade(indices)
+
+
+    def _cascade(self, abcd):
+        # s11 of the networks terminated into the dut
+        with self.metrics.timer('cascade', len(abcd)):
+            return self.network_library.engine.terminate(abcd, self.gamma_load)
+
+
+    def _get_bound(self):
+        if not self.branch_and_bound:
+            return None
+        return self.evaluator.get_bound(self.network_library.frequency)
+
+
+    def _get_coarse_screen(self):
+        if not self.coarse_step:
+            return None
+        if not self.batch_size or self.pipeline:
+            logging.warning('the coarse screen is only used by the batched, parallel and meet in the middle sweeps')
+            return None
+        bound = self.evaluator.get_bound(self.network_library.frequency)
+        if bound is None:
+            logging.warning('the coarse screen needs band limits (Evaluator.get_bound()), running without it')
+            return None
+        coarse = CoarseScreen(self.network_library.engine, bound, self.coarse_step, self.coarse_margin_db)
+        logging.info('coarse screen on %d of %d points' % (len(coarse.points), coarse.n_freq))
+        return coarse
+
+
+    def _evaluate_batch(self, indices):
+        # s11 of a batch, with a coarse screen only of the survivors: returns (s11, rows of the survivors or None)
+        if self.coarse is None:
+            return (self._cascade(self._build(indices)), None)
+        with self.metrics.timer('coarse', len(indices)):
+            coarse_s11 = self.coarse.evaluate(indices, self.gamma_load)
+        return self._refine(indices, coarse_s11)
+
+
+    def _refine(self, indices, coarse_s11):
+        # full grid s11 of the candidates that survive the coarse screen
+        rows = np.flatnonzero(self.coarse.screen(coarse_s11))
+        return (self._cascade(self._build(indices[rows])), rows)
+
+
+    def _evaluate_candidate(self, i, network, variation, all_feasible_results):
+        ev_result = self.evaluator.evaluate((i, network, variation))
+        if ev_result != None:
+            self.evaluator.print_result(ev_result)
+            all_feasible_results.append(ev_result)
+        return ev_result
+
+
+    def _score_batch(self, numbers, s11, rows = None):
+        # returns (Evaluator.screen() mask, Evaluator.score()) of a batch, s11 only of the rows (if given)
+        frequency = self.network_library.engine.frequency
+        with self.metrics.timer('band', len(numbers) if rows is None else len(rows)):
+            return _score_rows(self.scorer, numbers, s11, frequency, rows)
+
+
+    def _record_batch(self, numbers, variations, indices, s11, simulation_result, all_feasible_results, rows = None):
+        # screen + score a batch, feed the store and the collectors, evaluate the candidates that pass the screen
+        (mask, scores) = self._score_batch(numbers, s11, rows)
+        return self._collect_batch(numbers, variations, indices, s11, mask, scores, simulation_result, all_feasible_results, rows)
+
+
+    def _collect_batch(self, numbers, variations, indices, s11, mask, scores, simulation_result, all_feasible_results,
+                       rows = None):
+        engine = self.network_library.engine
+        with self.metrics.timer('collect', len(numbers)):
+            if self.result_store is not None:
+                self.result_store.append(numbers, indices, scores, mask)
+            for collector in self.collectors:
+                collector.add_batch(numbers, scores, mask)
+        candidates = np.flatnonzero(mask)
+        with self.metrics.timer('evaluate', len(candidates)):
+            for (k, row) in zip(candidates, candidates if rows is None else np.searchsorted(rows, candidates)):
+                i = int(numbers[k])
+                network = engine.to_network(s11[row] if s11.ndim == 2 else s11[row, 0], name=str(i)) # first state
+                ev_result = self._evaluate_candidate(i, network, variations[k], all_feasible_results)
+                if ev_result != None:
+                    simulation_result = ev_result
+        return simulation_result
+
+
+    def _simulate_batched(self, start, simulation_result, all_feasible_results):
+        next_number = start
+        for (start, variations, indices, s11, rows) in self._iter_evaluated_batches(start):
+            numbers = np.arange(start, start + len(variations))
+            simulation_result = self._record_batch(numbers, variations, indices, s11, simulation_result, all_feasible_results, rows)
+            next_number = start + len(variations)
+            self.metrics.progress(next_number)
+            self._checkpoint(next_number, simulation_result, all_feasible_results)
+
+        next_number = len(self.network_library.variation_space) # pruned subtrees at the end
+        self._checkpoint(next_number, simulation_result, all_feasible_results, force=True)
+        if self.result_store is not None:
+            self.result_store.flush()
+        return (simulation_result, all_feasible_results)
+
+
+    def _simulate_pipelined(self, start, simulation_result, all_feasible_results):
+        '''
+        the batched sweep as a chain of stages with bounded queues in between:
+        generate (variation batches) -> build (CascadeEngine.cascade()) -> cascade (termination into the dut)
+        -> score (Evaluator.screen() + score()) -> collect (result store, collectors, evaluate(), checkpoints)
+        every stage runs on pipeline_workers[stage] threads, collect in this thread in the order of the variations
+        with prefix_sharing / branch_and_bound the generator already yields s11 and build + cascade are skipped
+        the per stage counters end up in pipeline_stats and the log, the busiest stage is the bottleneck
+        '''
+        library = self.network_library
+        workers = self.pipeline_workers
+        state = {'result': simulation_result} # last result accepted by the evaluator
+
+        def build(batch):
+            (first, variations, indices) = batch
+            return (first, variations, indices, self._build(indices))
+
+        def cascade(batch):
+            (first, variations, indices, abcd) = batch
+            return (first, variations, indices, self._cascade(abcd))
+
+        def score(batch):
+            (first, variations, indices, s11) = batch
+            numbers = np.arange(first, first + len(variations))
+            return (numbers, variations, indices, s11) + self._score_batch(numbers, s11)
+
+        def collect(batch):
+            state['result'] = self._collect_batch(*batch, state['result'], all_feasible_results)
+            next_number = int(batch[0][-1]) + 1
+            self.metrics.progress(next_number)
+            self._checkpoint(next_number, state['result'], all_feasible_results)
+
+        stages = [Stage('score', score, workers['score'])]
+        if self.prefix_sharing or self.branch_and_bound:
+            source = library.iter_prefix_batches(self.gamma_load, self.batch_size, start, bound=self._get_bound())
         else:
-            self.networks = networks
-        self.length = len(self.networks)
-        self.index = 0
-
-    def add_network(self, network):
-        self.networks.append(network)
-        self.length += 1
-
-    def draw_network_cyclic(self):
-        if self.index >= self.length:
-            self.index = 0
-        result = self.networks[self.index]
-        self.index += 1
-        return result
+            library.seek(start)
+            source = library.iter_batches(self.batch_size, start)
+            stages = [Stage('build', build, workers['build']), Stage('cascade', cascade, workers['cascade'])] + stages
 
+        pipeline = Pipeline(stages, PIPELINE_QUEUE_SIZE)
+        try:
+            pipeline.run(source, collect)
+        finally:
+            self.pipeline_stats = pipeline.get_stats()
+            pipeline.log_stats()
 
-# makes the neccessary copies for every component
-class ComponentPool():
-    def __init__(self, components, network_description):
-        self.pool = {} # dictionary where every key is the component's name and the items are ComponentPoolEntry
-        self.components = components
-        self.network_description = network_description
-        self.shunt_copies = 0
-        self.series_copies = 0
-        self._init_copies()
-
-    def _determine_copy_counts(self):
-        for comp_key in self.network_description:
-            if comp_key == CompKey.SHUNT:
-                self.shunt_copies += 1
-            elif comp_key == CompKey.SERIES:
-                self.series_copies += 1
-
-    def _init_copies(self):
-        self._determine_copy_counts()
-        for component in self.components:
-            key = self._get_key_from_component(component)
-            orig_network = component.network
-            num_of_copies = 0
-            if component.type == CompType.TRUESHUNT or component.type == CompType.FALSESHUNT:
-                num_of_copies = self.shunt_copies
-            elif component.type == CompType.TRUESERIES or component.type == CompType.FALSESERIES:
-                num_of_copies = self.series_copies
+        next_number = len(library.variation_space) # pruned subtrees at the end
+        self._checkpoint(next_number, state['result'], all_feasible_results, force=True)
+        if self.result_store is not None:
+            self.result_store.flush()
+        return (state['result'], all_feasible_results)
 
-            entry = ComponentPoolEntry()
-            #print('KEY: ' + key)
-            for i in range(0, num_of_copies):
-                copied_network = orig_network.copy()
-                copied_network.name += '_copy_' + str(i)
-                #print(copied_network.name)
-                entry.add_network(copied_network)
-            self.pool[key] = entry
 
+    def _simulate_meet_in_the_middle(self, start, simulation_result, all_feasible_results):
+        '''
+        only cascades the variations the SmithIndex can't rule out with the pointwise limits of
+        Evaluator.get_bound() (e.g. max_db), the others are skipped like the pruned subtrees of branch_and_bound
+        '''
+        library = self.network_library
+        bound = self.evaluator.get_bound(library.frequency)
+        limit = None if bound is None else bound.get_pointwise_limit()
+        if limit is None or not np.isfinite(limit).any():
+            logging.warning('meet in the middle needs pointwise limits (e.g. max_db), running the full sweep')
+            return self._simulate_batched(start, simulation_result, all_feasible_results)
+
+        gamma_dut = self.dut.s[:, 0, 0] # passing in the first state is necessary for passing in all of them
+        template = library.variation_template
+        numbers = []
+        with self.metrics.timer('index'):
+            smith_index = SmithIndex(library.engine, gamma_dut, limit)
+            for positions in smith_index.iter_candidates([[component.index for component in slot] for slot in template]):
+                for row in zip(*np.unravel_index(positions, [len(slot) for slot in template])):
+                    numbers.append(library.variation_space.index_of(tuple(slot[position] for (slot, position) in zip(template, row))))
+        numbers = np.sort(np.array(numbers, dtype=np.int64))
+        numbers = numbers[numbers >= start]
+        logging.info('meet in the middle: %d of %d variations left' % (len(numbers), len(library.variation_space)))
+
+        for first in range(0, len(numbers), self.batch_size):
+            batch = numbers[first:first + self.batch_size]
+            variations = [library.variation_space[int(i)] for i in batch]
+            indices = np.array([[component.index for component in variation] for variation in variations], dtype=np.intp)
+            (s11, rows) = self._evaluate_batch(indices)
+            simulation_result = self._record_batch(batch, variations, indices, s11, simulation_result, all_feasible_results, rows)
+            self.metrics.progress(int(batch[-1]) + 1)
+            self._checkpoint(int(batch[-1]) + 1, simulation_result, all_feasible_results)
+
+        self._checkpoint(len(library.variation_space), simulation_result, all_feasible_results, force=True)
+        if self.result_store is not None:
+            self.result_store.flush()
+        return (simulation_result, all_feasible_results)
 
-    def _get_key_from_component(self, component):
-        return component.network.name
 
-    def draw_network(self, component):
-        key = self._get_key_from_component(component)
-        return self.pool[key].draw_network_cyclic()
+    def _simulate_parallel(self, start, simulation_result, all_feasible_results):
+        '''
+        shards the variation space into contiguous index ranges of SHARD_SIZE variations
+        - every worker gets the engine, a VariationSpace of component indices, the dut and
+          the evaluator once via the pool initializer, a task is just (start, stop)
+        - the workers send back the feasible numbers and their shard's copy of the collectors,
+          the (numbers, components, scores, feasible) arrays only if there is a result store
+        - at most 2 shards per process are in flight (the results are consumed in order), the feasible candidates
+          are rebuilt and passed to evaluate() in the main process, so the result is the same as with the serial run
+        - with self.pool the shards run there (shared with other sweeps) instead of on an own Pool
+        '''
+        library = self.network_library
+        engine = library.engine
+        index_space = VariationSpace([[component.index for component in slot] for slot in library.variation_template])
+        tasks = library.iter_shards(SHARD_SIZE, start)
+        initargs = (engine, index_space, self.gamma_load, self.scorer, self.collectors, self.batch_size, self._get_bound(),
+                    self.coarse, self.result_store is not None)
+        next_number = start
+        pool = None
+        if self.pool is None:
+            pool = Pool(self.processes, initializer=_init_worker, initargs=initargs)
+            results = _imap_window(pool, _run_worker, tasks, 2 * self.processes)
+        else:
+            results = self.pool.imap(initargs, tasks)
+        try:
+            for ((start, next_number), result) in results:
+                (record, feasible_numbers, shard_collectors, timers) = result
+                self.metrics.merge(timers)
+                self.metrics.progress(next_number)
+                for (collector, shard_collector) in zip(self.collectors, shard_collectors):
+                    collector.merge(shard_collector)
+                if record is not None:
+                    with self.metrics.timer('collect', 0): # the rows are counted by the workers
+                        self.result_store.append(*record)
+                with self.metrics.timer('evaluate', len(feasible_numbers)):
+                    for i in feasible_numbers:
+                        (i, network, variation) = self.get_result(int(i))
+                        ev_result = self._evaluate_candidate(i, network, variation, all_feasible_results)
+                        if ev_result != None:
+                            simulation_result = ev_result
+
+                self._checkpoint(next_number, simulation_result, all_feasible_results)
+        finally:
+            results.close()
+            if pool is not None:
+                pool.terminate()
+
+        self._checkpoint(next_number, simulation_result, all_feasible_results, force=True)
+        if self.result_store is not None:
+            self.result_store.flush()
+        return (simulation_result, all_feasible_results)
+
+
+# (task, func(task)) in the order of tasks, with at most window tasks submitted to the pool at a time
+def _imap_window(pool, func, tasks, window):
+    pending = deque()
+    for task in tasks:
+        pending.append((task, pool.apply_async(func, (task,))))
+        if len(pending) >= window:
+            (task, result) = pending.popleft()
+            yield (task, result.get())
+    while pending:
+        (task, result) = pending.popleft()
+        yield (task, result.get())
+
+
+# state of the worker processes of MatchingSimulationManager._simulate_parallel()
+_worker_state = {}
+
+def _init_worker(engine, index_space, gamma_load, evaluator, collectors, batch_size, bound, coarse, records):
+    _worker_state['engine'] = engine
+    _worker_state['index_space'] = index_space
+    _worker_state['gamma_load'] = gamma_load
+    _worker_state['evaluator'] = evaluator
+    _worker_state['collectors'] = collectors
+    _worker_state['batch_size'] = batch_size
+    _worker_state['bound'] = bound
+    _worker_state['coarse'] = coarse
+    _worker_state['records'] = records # only sent back with a result store
+
+
+def _run_worker(task):
+    (start, stop) = task
+    engine = _worker_state['engine']
+    evaluator = _worker_state['evaluator']
+    numbers = []
+    components = []
+    scores = []
+    feasible = []
+    feasible_numbers = []
+    collectors = [collector.empty() for collector in _worker_state['collectors']]
+    metrics = Metrics()
+    coarse = _worker_state['coarse']
+    gamma_load = _worker_state['gamma_load']
+    records = _worker_state['records']
+    for (block_start, index_lists) in _worker_state['index_space'].iter_blocks(start, stop):
+        tails = None
+        if coarse is None:
+            blocks = engine.iter_block(index_lists, gamma_load, _worker_state['batch_size'], _worker_state['bound'])
+            blocks = metrics.iter_timed('cascade', blocks, size=lambda block: len(block[2]))
+        else: # the coarse screen is the (stricter) bound
+            blocks = coarse.engine.iter_block(index_lists, coarse.get_gamma_load(gamma_load), _worker_state['batch_size'],
+                                              coarse if _worker_state['bound'] is not None else None)
+            blocks = metrics.iter_timed('coarse', blocks, size=lambda block: len(block[2]))
+        for (offset, positions, s11) in blocks:
+            if tails is None:
+                tails = _get_product_indices(index_lists[len(positions):])
+            batch_numbers = np.arange(block_start + offset, block_start + offset + len(s11))
+            batch_components = None
+            rows = None
+            if coarse is not None:
+                rows = np.flatnonzero(coarse.screen(s11))
+                batch_components = _join_indices(index_lists, positions, tails)
+                with metrics.timer('cascade', len(rows)):
+                    s11 = engine.evaluate(batch_components[rows], gamma_load)
+            with metrics.timer('band', len(s11)):
+                (mask, batch_scores) = _score_rows(evaluator, batch_numbers, s11, engine.frequency, rows)
+            with metrics.timer('collect', len(batch_numbers)):
+                for collector in collectors:
+                    collector.add_batch(batch_numbers, batch_scores, mask)
+                feasible_numbers.append(batch_numbers[mask])
+                if records:
+                    numbers.append(batch_numbers)
+                    components.append(_join_indices(index_lists, positions, tails) if batch_components is None
+                                      else batch_components)
+                    scores.append(batch_scores)
+                    feasible.append(mask)
+    feasible_numbers = np.concatenate(feasible_numbers) if feasible_numbers else np.zeros(0, dtype=np.int64)
+    if not numbers: # no store or everything pruned
+        return (None, feasible_numbers, collectors, metrics.timers)
+    record = (np.concatenate(numbers), np.concatenate(components), np.concatenate(scores), np.concatenate(feasible))
+    return (record, feasible_numbers, collectors, metrics.timers)
+
+
+# (screen mask, scores) of a batch, s11 only of the rows (if given): the other variations fail, their scores are nan
+def _score_rows(evaluator, numbers, s11, frequency, rows = None):
+    if rows is None:
+        mask = np.asarray(evaluator.screen(numbers, s11, frequency), dtype=bool)
+        return (mask, np.asarray(evaluator.score(numbers, s11, frequency)))
+    row_mask = np.asarray(evaluator.screen(numbers[rows], s11, frequency), dtype=bool)
+    row_scores = np.asarray(evaluator.score(numbers[rows], s11, frequency), dtype=float)
+    mask = np.zeros(len(numbers), dtype=bool)
+    mask[rows] = row_mask
+    scores = np.full((len(numbers),) + row_scores.shape[1:], np.nan)
+    scores[rows] = row_scores
+    return (mask, scores)
+
+
+# component indices of product(*index_lists) [n, len(index_lists)]
+def _get_product_indices(index_lists):
+    grids = np.meshgrid(*[np.asarray(indices, dtype=np.intp) for indices in index_lists], indexing='ij')
+    return np.stack([grid.ravel() for grid in grids], axis=1)
+
+
+# component indices of the batches of CascadeEngine.iter_block() [n, depth]
+def _join_indices(index_lists, positions, tails):
+    head = [index_lists[depth][position] for (depth, position) in enumerate(positions)]
+    return np.concatenate([np.broadcast_to(np.asarray(head, dtype=np.intp), (len(tails), len(head))), tails], axis=1)
+
+
+class FeasibleResults():
+    '''
+    list of the results accepted by the evaluator, only the variation numbers are kept,
+    the networks are rebuilt on access (see MatchingSimulationManager.get_result())
+    '''
+    def __init__(self, manager, numbers = ()):
+        self.manager = manager
+        self.numbers = array('q', numbers)
+
+    def append(self, ev_result):
+        self.numbers.append(ev_result[0])
+
+    def __len__(self):
+        return len(self.numbers)
+
+    def __getitem__(self, key):
+        if isinstance(key, slice):
+            return [self.manager.get_result(i) for i in self.numbers[key]]
+        return self.manager.get_result(self.numbers[key])
+
+    def __iter__(self):
+        for i in self.numbers:
+            yield self.manager.get_result(i)
 
 
 class MatchingComponent():
+    # network: the file as read (and harmonized), released once the library holds the shared arrays,
+    # then MatchingNetworkLibrary.get_network() builds it from MatchingNetworkLibrary.s / z0
+    __slots__ = ('network', 'type', 'name', 'index')
+
     def __init__(self, network, type, name):
         self.network = network
         self.type = type
         self.name = name
+        self.index = None # row in the CascadeEngine
 
     def needs_ground(self):
         # idk if falseseries really works or makes sense
@@ -180,17 +866,30 @@ class MatchingComponent():
 
 
 class MatchingNetworkLibrary():
-    def __init__(self, series_dir = None, shunt_dir = None):
+    def __init__(self, series_dir = None, shunt_dir = None, cache = None, part_filter = None, index_path = None):
+        self.series_dir = series_dir or 'components/series'
+        self.shunt_dir = shunt_dir or 'components/shunt'
+        # e.g. {'kind': 'L', 'size': '0402', 'min_value': 1e-9, 'max_value': 30e-9}, None -> every file
+        self.part_filter = part_filter
+        self.index = ComponentIndex(index_path) if part_filter is not None else None
         self.components = [] # -> [MatchingComponent]
         self.network_description = None
         self.frequency = None
+        self.dut = None # resampled onto self.frequency (the first state for several duts)
+        self.duts = [] # all dut states
         self.component_variations = None # iter
+        self.variation_template = None # [[MatchingComponent]] for every slot
+        self.variation_space = None # random access to the variations
+        self.equivalents = None # component index -> [MatchingComponent] of its equivalence class (see expand())
         self.number_of_variations = None
 
-        self.components += self._read_all_from_dir('components/series')
-        self.components += self._read_all_from_dir('components/shunt')
+        self.cache = cache # LibraryCache, None -> no cache
+        if cache is None: # with a cache the files are only read on a miss
+            self._read_components()
 
-        self.component_pool = None
+        self.s = None # read-only S-parameters of all components [n_components, n_freq, 2, 2]
+        self.z0 = None # [n_components, n_freq, 2]
+        self.engine = None
 
         self.line = None
 
@@ -211,39 +910,100 @@ class MatchingNetworkLibrary():
         #    raise StopIteration
 
 
-    def _make_frequencies_common(self, dut = None):
-        # little inefficient, was better with NetworkSets but it's ok.
-        common_freq = None
-        # inject dut (hacky way)
-        if dut:
-            self.components.append(MatchingComponent(dut, CompType.TRUESERIES, 'antenna'))
-
-        network_a = None
-        network_b = None
-        combs = combinations(self.components, 2)
-        for components in combs:
-            network_a = components[0].network
-            network_b = components[1].network
-
-            if network_a.frequency.npoints >= network_b.frequency.npoints:
-                large_network = network_a
-                small_network = network_b
-            else:
-                large_network = network_b
-                small_network = network_a
-
-            (components[0].network, components[1].network) = rf.network.overlap(large_network, small_network)
-
-        self.frequency = network_b.frequency # hack! TODO: figure out right network network_b or network_a to assign to self.frequency dynamically
-        self.components.pop()
-
-
-    def _read_all_from_dir(self, dir):
+    def _make_frequencies_common(self, dut = None, frequency = None):
+        '''
+        resamples all components (and the dut) once onto the common frequency range
+        dut: a Network or a list of them (dut states)
+        frequency: optional target grid (rf.Frequency), default: the densest grid of the components/dut
+        returns the resampled dut
+        '''
+        duts = _get_duts(dut)
+        networks = [component.network for component in self.components] + duts
+        (self.frequency, networks) = harmonize(networks, frequency)
+        for (component, network) in zip(self.components, networks):
+            component.network = network
+        self._set_duts(networks[len(self.components):])
+        return self.dut
+
+
+    def _set_duts(self, duts):
+        self.duts = list(duts)
+        if self.duts:
+            self.dut = self.duts[0]
+
+
+    def _read_components(self):
+        self.components = []
+        if self.part_filter is not None: # only the selected files
+            for (path, type_name) in self._list_component_files():
+                network = rf.Network(path)
+                self.components.append(MatchingComponent(network, CompType[type_name], network.name))
+            if not self.components:
+                raise ValueError('part filter %r does not select any component file' % (self.part_filter,))
+            return
+        self.components += self._read_all_from_dir(self.series_dir, True)
+        self.components += self._read_all_from_dir(self.shunt_dir, False)
+
+
+    def _list_component_files(self):
+        # [(path, type name)] of the files _read_components() would read (same selection as rf.read_all())
+        files = self._list_all_component_files()
+        if self.part_filter is None:
+            return files
+        self.index.update(files)
+        selected = set(entry['path'] for entry in self.index.select(**self.part_filter))
+        logging.info('part filter: %d of %d files selected' % (len(selected), len(files)))
+        return [(path, type_name) for (path, type_name) in files if path in selected]
+
+
+    def _list_all_component_files(self):
+        files = []
+        for (dir, series) in [(self.series_dir, True), (self.shunt_dir, False)]:
+            for subdir in sorted(os.listdir(dir)):
+                subpath = os.path.join(dir, subdir)
+                comp_type = _get_comp_type_from_dir(subpath, series)
+                if comp_type == None:
+                    continue
+                for path in sorted(glob.glob(os.path.join(subpath, '*.s*p'))):
+                    if 's2p' in path:
+                        files.append((path, comp_type.name))
+        return files
+
+
+    def _load_cache(self, dut, frequency):
+        '''
+        restores the harmonized components (and the dut) from the cache
+        returns (cache key, engine matrices), the matrices are None on a miss
+        '''
+        duts = _get_duts(dut)
+        dut_frequency = [network.frequency for network in duts] if len(duts) > 1 else (duts[0].frequency if duts else None)
+        key = self.cache.get_key(self._list_component_files(), dut_frequency, frequency, Z_0)
+        entry = self.cache.load(key)
+        if entry is None:
+            return (key, None)
+        self.frequency = entry['frequency']
+        self.components = []
+        for (k, (name, type_name)) in enumerate(zip(entry['names'], entry['types'])):
+            self.components.append(MatchingComponent(None, CompType[type_name], name)) # see get_network()
+        self._init_shared_arrays(entry['s'], entry['z0'])
+        self._set_duts(resample(duts, self.frequency))
+        return (key, entry['abcd'])
+
+
+    def _store_cache(self, key):
+        self.cache.store(key, self.frequency,
+                         [component.name for component in self.components],
+                         [component.type.name for component in self.components],
+                         self.s, self.z0,
+                         self.engine.abcd)
+
+
+    def _read_all_from_dir(self, dir, series = True):
         subdirs = os.listdir(dir)
         all = []
         for subdir in subdirs:
             subpath = os.path.join(dir, subdir)
-            comp_type = _get_comp_type_from_dir(subpath)
+            comp_type = _get_comp_type_from_dir(subpath, series)
             if comp_type == None:
                 continue
             temp_dict = rf.read_all(subpath, contains='s2p')
@@ -272,6 +1032,120 @@ class MatchingNetworkLibrary():
         return result
 
 
+    def _get_equivalents(self, tolerance):
+        '''
+        groups the parts of every slot into classes of parts whose two-ports (as they end up in the cascade,
+        so a false series part can end up with a true series one) differ by at most tolerance in S
+        the slots only keep the representatives, returns {component index: [members of its class]}
+        '''
+        equivalents = {}
+        reduced = {} # id of a slot list -> representatives (the slots of the same kind share their list)
+        for slot in self.variation_template:
+            if id(slot) in reduced:
+                continue
+            indices = [component.index for component in slot]
+            s = abcd_to_s(self.engine.abcd[indices], self.engine.z0)
+            representatives = get_equivalence_classes(s, tolerance)
+            for (component, representative) in zip(slot, representatives):
+                equivalents.setdefault(slot[representative].index, []).append(component)
+            reduced[id(slot)] = [slot[k] for k in np.unique(representatives)]
+            logging.info('%d equivalence classes of %d parts' % (len(reduced[id(slot)]), len(slot)))
+        self.variation_template = [reduced[id(slot)] for slot in self.variation_template]
+        return equivalents
+
+
+    def fork(self, dut = None):
+        '''
+        library for another sweep on the same components: shares the harmonized components, the grid
+        and the engine (nothing is read or copied), the variations are initialized with init_variations()
+        dut: the dut(s) of the new sweep, resampled onto the grid of this library (default: the same duts)
+        '''
+        library = copy.copy(self)
+        library.network_description = None
+        library.component_variations = None
+        library.variation_template = None
+        library.variation_space = None
+        library.equivalents = None
+        if dut is not None:
+            library._set_duts(resample(_get_duts(dut), self.frequency))
+        return library
+
+
+    def expand(self, variation):
+        # all variations with the parts of the equivalence classes of variation (the variation itself comes first)
+        if self.equivalents is None:
+            return [tuple(variation)]
+        return list(product(*[self.equivalents[component.index] for component in variation]))
+
+
+    def seek(self, start):
+        # the next variation returned by __next__() / iter_batches() will be variation number start
+        self.component_variations = self.variation_space.iter_range(start, len(self.variation_space))
+
+
+    def iter_batches(self, batch_size, start = 0):
+        '''
+        consumes the variations in chunks
+        start: number of the next variation (only used for the numbering, see seek())
+        yields (number of the first variation, [variation], component indices [batch, depth])
+        '''
+        while True:
+            variations = list(islice(self.component_variations, batch_size))
+            if not variations:
+                return
+            indices = np.array([[component.index for component in variation] for variation in variations], dtype=np.intp)
+            yield (start, variations, indices)
+            start += len(variations)
+
+
+    def iter_prefix_batches(self, gamma_load, batch_size, start = 0, stop = None, bound = None, engine = None):
+        '''
+        depth first alternative to iter_batches() + CascadeEngine.evaluate()
+        walks the blocks of the variation space and reuses the partial cascades
+        the order of the variations is exactly the same (minus the subtrees pruned by bound)
+        engine: defaults to self.engine (e.g. CoarseScreen.engine, gamma_load then on its points)
+        yields (number of the first variation, [variation], component indices [batch, depth], s11 [batch, n_freq])
+        '''
+        engine = engine if engine is not None else self.engine
+        for (block_start, block) in self.variation_space.iter_blocks(start, stop):
+            index_lists = [[component.index for component in slot] for slot in block]
+            tails = None
+            for (offset, positions, s11) in engine.iter_block(index_lists, gamma_load, batch_size, bound):
+                if tails is None:
+                    tails = list(product(*block[len(positions):]))
+                    tail_indices = _get_product_indices(index_lists[len(positions):])
+                head = tuple(block[depth][position] for (depth, position) in enumerate(positions))
+                variations = [head + tail for tail in tails]
+                yield (block_start + offset, variations, _join_indices(index_lists, positions, tail_indices), s11)
+
+
+    def iter_shards(self, shard_size, start = 0):
+        # splits the variation space (from start on) into index ranges (start, stop)
+        for first in range(start, len(self.variation_space), shard_size):
+            yield (first, min(first + shard_size, len(self.variation_space)))
+
+
+    def _get_two_port(self, component):
+        # network as it ends up in the cascade
+        if component.needs_ground():
+            return self.line.shunt(self.get_network(component) ** self.line.short()) # creates a tee where one port goes to ground
+        return self.get_network(component)
+
+
+    def get_network(self, component):
+        # network of a component on the common grid, a writable copy of its rows of the shared arrays
+        return rf.Network(frequency=self.frequency, s=np.array(self.s[component.index]), z0=np.array(self.z0[component.index]),
+                          name=component.name)
+
+
+    def _init_engine(self, abcd = None):
+        # abcd: precomputed matrices (from the cache), else computed from the components
+        for (index, component) in enumerate(self.components):
+            component.index = index
+        networks = None if abcd is not None else [self._get_two_port(component) for component in self.components]
+        self.engine = CascadeEngine(networks, self.frequency, z0=Z_0, abcd=abcd)
+
+
     # alternative to _build_circuit() because circuit.network is slow
     def _build_network(self, variation):
         short = self.line.short()
@@ -279,7 +1153,7 @@ class MatchingNetworkLibrary():
         started = False
         # just hacked rn TODO: clean it up
         for component in variation:
-            current_network = self.component_pool.draw_network(component)
+            current_network = self.get_network(component)
             if not started:
 
                 if component.needs_ground():
@@ -312,13 +1186,9 @@ class MatchingNetworkLibrary():
         # it's messy but ok
         for component in variation:
 
-            #current_network = component.network.copy()
-            # - network.copy() takes a lot of time and memory
-            # - components are copied for _every_ circuit
-            # - solution: it is known how many copies are needed at max based on the network_description
-            # - create a pool of copies and then draw from the pool when needed instead of using network.copy() here
-
-            current_network = self.component_pool.draw_network(component)
+            # rf.Circuit tells the networks apart by name, so every position gets its own network
+            current_network = self.get_network(component)
+            current_network.name = component.name + '_' + str(name_index)
 
             if component.type == CompType.TRUESERIES or component.type == CompType.TRUESHUNT:
                 current_connexion.append((current_network, 0))
@@ -350,53 +1220,101 @@ class MatchingNetworkLibrary():
         return result
 
 
-    def _init_component_pool(self):
-        self.component_pool = ComponentPool(self.components, self.network_description)
+    def _init_shared_arrays(self, s = None, z0 = None):
+        '''
+        puts the S-parameters and port impedances of all components into one read-only array each
+        (or uses s, z0, e.g. the cache memmaps) and releases the networks of the components,
+        so the library is held in memory once, independent of the network depth (see get_network())
+        '''
+        if s is None:
+            s = np.stack([component.network.s for component in self.components])
+            z0 = np.stack([component.network.z0 for component in self.components])
+        (s, z0) = (s.view(np.ndarray), z0.view(np.ndarray))
+        s.flags.writeable = False
+        z0.flags.writeable = False
+        for component in self.components:
+            component.network = None
+        self.s = s
+        self.z0 = z0
+
 
+    def init_network_variations(self, network_description, dut = None, frequency = None, equivalence_tolerance = None): # TODO: rename
+        self.init_components(dut, frequency)
+        self.init_variations(network_description, equivalence_tolerance)
 
-    def init_network_variations(self, network_description, dut = None): # TODO: rename
-        self.network_description = network_description
-        self._make_frequencies_common(dut)
-        self.line = rf.DefinedGammaZ0(frequency=self.frequency, z0=50)
 
-        for comp in self.components:
-            print(comp.network.frequency)
+    def init_components(self, dut = None, frequency = None):
+        # harmonized components (from the cache if there is one), the dut(s) on the common grid and the engine
+        abcd = None
+        if self.cache is not None:
+            (cache_key, abcd) = self._load_cache(dut, frequency)
+            if abcd is None:
+                self._read_components()
+        if abcd is None:
+            self._make_frequencies_common(dut, frequency)
+            self._init_shared_arrays()
+        self.line = rf.DefinedGammaZ0(frequency=self.frequency, z0=Z_0)
 
-        self._init_component_pool()
-        variation_template = self._parse_network_template_description(network_description)
-        self.component_variations = iter(_specific_order_cartesian(variation_template))
+        logging.debug('common frequency grid of %d components: %s' % (len(self.components), self.frequency))
+
+        self._init_engine(abcd)
+        if self.cache is not None and abcd is None:
+            self._store_cache(cache_key)
+
+
+    def init_variations(self, network_description, equivalence_tolerance = None):
+        self.network_description = network_description
+        self.variation_template = self._parse_network_template_description(network_description)
+        if equivalence_tolerance is not None:
+            self.equivalents = self._get_equivalents(equivalence_tolerance)
+        self.variation_space = VariationSpace(self.variation_template)
+        self.component_variations = iter(_specific_order_cartesian(self.variation_template))
 
 
 # https://stackoverflow.com/questions/69368419/cartesian-product-with-specific-order
 def _specific_order_cartesian(lists):
+    for block in _specific_order_blocks(lists):
+        yield from product(*block)
+
+
+# the specific order is a sequence of plain cartesian products ("blocks"),
+# yielding the blocks instead of the tuples allows evaluating them prefix by prefix
+def _specific_order_blocks(lists):
     its = [[lst[0]] for lst in lists]
-    yield tuple(lst[0] for lst in lists)
+    yield [[lst[0]] for lst in lists]
 
     for column in list(islice(zip_longest(*lists), 1, None)):
         for i, p in reversed(list(enumerate(column))):
             if p is None:
                 continue
 
-            yield from product(
-                *(
-                    (p,) if j == i else its[j]
-                    for j in range(len(lists))
-                )
-            )
+            yield [
+                [p] if j == i else list(its[j])
+                for j in range(len(lists))
+            ]
 
             its[i].append(p)
 
 
-def _get_comp_type_from_dir(dir):
+# dut argument (None, a Network or a list of them) -> list of networks
+def _get_duts(dut):
+    if dut is None:
+        return []
+    if isinstance(dut, (list, tuple)):
+        return list(dut)
+    return [dut]
+
+
+def _get_comp_type_from_dir(dir, series = True):
+    # dir: subdirectory of the series (series = True) or of the shunt directory
     if not os.path.isdir(dir):
         return None
     end_dir = os.path.basename(os.path.normpath(dir))
-    type = None
-    if dir.startswith('components/series'):
+    if series:
         type = CompType.TRUESERIES
         if end_dir.startswith('shunt'):
             type = CompType.FALSESERIES
-    elif dir.startswith('components/shunt'):
+    else:
         type = CompType.TRUESHUNT
         if end_dir.startswith('series'):
             type = CompType.FALSESHUNT
@@ -0,0 +1,187 @@
+import csv
+import json
+import logging
+import sys
+import threading
+import time
+
+try:
+    import resource
+except ImportError: # windows
+    resource = None
+
+LOG_INTERVAL = 10 # seconds between two progress lines
+
+
+def get_peak_rss():
+    # peak resident set size of this process in MB (None if unknown)
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform == 'darwin':
+        return peak / 2 ** 20 # bytes
+    return peak / 2 ** 10 # kB
+
+
+class _Timer():
+    __slots__ = ('metrics', 'name', 'items', 'begin')
+
+    def __init__(self, metrics, name, items):
+        self.metrics = metrics
+        self.name = name
+        self.items = items
+
+    def __enter__(self):
+        self.begin = time.perf_counter()
+        return self
+
+    def __exit__(self, *exception):
+        self.metrics.add(self.name, time.perf_counter() - self.begin, self.items)
+        return False
+
+
+class Metrics():
+    '''
+    timing counters of MatchingSimulationManager.simulate(), always on
+    (a timer costs about a microsecond and the batched modes only time whole batches):
+    - timers: name -> [calls, seconds, items], e.g. build (component cascades), cascade (termination into the dut),
+      band (Evaluator.screen() + score()), evaluate (Evaluator.evaluate() of the candidates)
+    - progress(): variations/s and eta from the size of the variation space, logged every log_interval seconds
+    - peak rss of the process (not of the pool workers)
+    export with write_json() / write_csv() at the end of a run
+    '''
+    def __init__(self, total = 0, done = 0, log_interval = LOG_INTERVAL):
+        self.timers = {}
+        self.lock = threading.Lock() # stages of the pipelined sweep run in threads
+        self.log_interval = log_interval
+        self.start(total, done)
+
+
+    def start(self, total, done = 0):
+        # total: number of variations of the sweep, done: first variation (resumed runs)
+        self.timers.clear()
+        self.total = total
+        self.first = done
+        self.done = done
+        self.start_time = time.perf_counter()
+        self.end_time = None
+        self._last_log = self.start_time
+
+
+    def timer(self, name, items = 1):
+        # with metrics.timer('build', len(indices)): ...
+        return _Timer(self, name, items)
+
+
+    def add(self, name, seconds, items = 1, calls = 1):
+        with self.lock:
+            timer = self.timers.get(name)
+            if timer is None:
+                timer = self.timers[name] = [0, 0.0, 0]
+            timer[0] += calls
+            timer[1] += seconds
+            timer[2] += items
+
+
+    def merge(self, timers):
+        # adds the timers of another Metrics object (e.g. of a pool worker)
+        for (name, (calls, seconds, items)) in timers.items():
+            self.add(name, seconds, items, calls)
+
+
+    def iter_timed(self, name, iterable, size = len):
+        # times every next() of iterable, size(item) is the number of items it contains
+        iterator = iter(iterable)
+        while True:
+            begin = time.perf_counter()
+            try:
+                item = next(iterator)
+            except StopIteration:
+                return
+            self.add(name, time.perf_counter() - begin, size(item))
+            yield item
+
+
+    def progress(self, done):
+        # done: number of the next variation of the sweep
+        self.done = done
+        now = time.perf_counter()
+        if now - self._last_log >= self.log_interval:
+            self._last_log = now
+            logging.info(self.get_progress_str())
+
+
+    def finish(self):
+        self.end_time = time.perf_counter()
+
+
+    def get_elapsed(self):
+        return (self.end_time or time.perf_counter()) - self.start_time
+
+
+    def get_rate(self):
+        elapsed = self.get_elapsed()
+        return (self.done - self.first) / elapsed if elapsed > 0 else 0.0
+
+
+    def get_eta(self):
+        rate = self.get_rate()
+        if rate <= 0:
+            return None
+        return max(self.total - self.done, 0) / rate
+
+
+    def get_progress_str(self):
+        eta = self.get_eta()
+        return 'progress: %d of %d (%.0f variations/s, eta %s)' % (
+            self.done, self.total, self.get_rate(), 'n/a' if eta is None else '%.0f s' % eta)
+
+
+    def to_dict(self):
+        with self.lock:
+            timers = {name: {
+                'calls': calls,
+                'total_s': seconds,
+                'per_call_s': seconds / calls if calls else 0.0,
+                'items': items,
+                'per_item_s': seconds / items if items else 0.0,
+            } for (name, (calls, seconds, items)) in self.timers.items()}
+        return {
+            'elapsed_s': self.get_elapsed(),
+            'variations_done': self.done,
+            'variations_total': self.total,
+            'variations_per_s': self.get_rate(),
+            'eta_s': self.get_eta(),
+            'peak_rss_mb': get_peak_rss(),
+            'timers': timers,
+        }
+
+
+    def log(self):
+        summary = self.to_dict()
+        rss = 'n/a' if summary['peak_rss_mb'] is None else '%.0f MB' % summary['peak_rss_mb']
+        logging.info('%d variations in %.2f s (%.0f variations/s), peak rss %s' % (
+            summary['variations_done'] - self.first, summary['elapsed_s'], summary['variations_per_s'], rss))
+        for (name, timer) in summary['timers'].items():
+            logging.info('  %-10s %8d calls  %10.3f s  %10.1f us/call  %10.2f us/item' % (
+                name, timer['calls'], timer['total_s'], timer['per_call_s'] * 1e6, timer['per_item_s'] * 1e6))
+
+
+    def write_json(self, path):
+        with open(path, 'w') as f:
+            json.dump(self.to_dict(), f, indent=2)
+
+
+    def write_csv(self, path):
+        # one row per value: metric, value (timers as timers.<name>.<field>)
+        rows = []
+        for (key, value) in self.to_dict().items():
+            if key == 'timers':
+                for (name, timer) in value.items():
+                    rows.extend(('timers.%s.%s' % (name, field), x) for (field, x) in timer.items())
+            else:
+                rows.append((key, value))
+        with open(path, 'w', newline='') as f:
+            writer = csv.writer(f)
+            writer.writerow(['metric', 'value'])
+            writer.writerows(rows)
@@ -0,0 +1,36 @@
+import numpy as np
+
+
+class PartIndex():
+    '''
+    nominal values of the library parts, estimated from the CascadeEngine matrices at f_ref
+    (default: the lowest frequency, below the self resonance of the parts):
+    - a series element has ABCD [[1, Z], [0, 1]], a shunt element [[1, 0], [Y, 1]]
+    - Im(Z) > 0 -> inductor with L = Im(Z) / w, else capacitor with C = -1 / (w Im(Z))
+    used to map ideal L/C values (e.g. the optima of optitest.py) to the nearest real parts
+    '''
+    def __init__(self, library, f_ref = None):
+        engine = library.engine
+        f = engine.frequency.f
+        point = 0 if f_ref is None else int(np.argmin(np.abs(f - f_ref)))
+        omega = 2 * np.pi * f[point]
+        abcd = np.asarray(engine.abcd[:, point])
+        (b, c) = (abcd[:, 0, 1], abcd[:, 1, 0])
+        self.shunt = np.abs(c) * engine.z0 > np.abs(b) / engine.z0
+        with np.errstate(divide='ignore'):
+            z = np.where(self.shunt, 1 / c, b)
+        self.kinds = np.where(z.imag > 0, 'L', 'C')
+        with np.errstate(divide='ignore'):
+            self.values = np.where(z.imag > 0, z.imag / omega, -1 / (omega * z.imag))
+
+
+    def nearest(self, components, kind, shunt, value, k):
+        '''
+        the k parts of components (e.g. one slot of the variation template) of the same kind ('L'/'C')
+        and placement with the nominal values closest to value (on a log scale), closest first
+        '''
+        candidates = [component for component in components
+                      if self.kinds[component.index] == kind and self.shunt[component.index] == shunt]
+        distances = [abs(np.log(self.values[component.index] / value)) for component in candidates]
+        order = np.argsort(distances, kind='stable')[:k]
+        return [candidates[position] for position in order]
@@ -0,0 +1,194 @@
+import time
+import queue
+import threading
+import logging
+
+_DONE = object()
+POLL_INTERVAL = 0.1 # seconds between two checks of the stop event while a queue is full / empty
+
+
+class Stage():
+    '''
+    one step of a Pipeline, function(item) -> item for the next stage, run by workers threads
+    (numpy releases the GIL in the heavy array operations, so several workers do overlap)
+    counters: items processed, busy time, time spent waiting for input and blocked on a full output queue
+    '''
+    def __init__(self, name, function, workers = 1):
+        self.name = name
+        self.function = function
+        self.workers = workers
+        self.items = 0
+        self.busy = 0.0
+        self.waiting = 0.0
+        self.blocked = 0.0
+        self.lock = threading.Lock()
+
+    def count(self, busy, waiting, blocked):
+        with self.lock:
+            self.items += 1
+            self.busy += busy
+            self.waiting += waiting
+            self.blocked += blocked
+
+    def get_stats(self, elapsed):
+        return {
+            'stage': self.name,
+            'workers': self.workers,
+            'items': self.items,
+            'busy_s': self.busy,
+            'waiting_s': self.waiting,
+            'blocked_s': self.blocked,
+            'utilization': self.busy / (elapsed * self.workers) if elapsed > 0 else 0.0,
+            'capacity_per_s': self.items * self.workers / self.busy if self.busy > 0 else float('inf'),
+        }
+
+
+class _Failure():
+    def __init__(self, exception):
+        self.exception = exception
+
+
+class Pipeline():
+    '''
+    source -> stage -> ... -> stage -> sink with bounded queues between the steps (backpressure:
+    a fast stage blocks as soon as queue_size items wait for the next one)
+    the source runs in its own thread, the sink in the calling thread and gets the items in source order
+    when run() returns (also when the sink or a stage raises) the threads are stopped and joined
+    get_stats() shows the utilization of every stage, the bottleneck is the one close to 1
+    '''
+    def __init__(self, stages, queue_size = 4):
+        self.stages = stages
+        self.queue_size = queue_size
+        self.source_stage = Stage('generate', None)
+        self.sink_stage = Stage('collect', None)
+        self.elapsed = 0.0
+
+
+    def run(self, source, sink):
+        start = time.perf_counter()
+        queues = [queue.Queue(self.queue_size) for _ in range(len(self.stages) + 1)]
+        stop = threading.Event()
+        threads = [threading.Thread(target=self._run_source, args=(source, queues[0], stop), daemon=True)]
+        for (k, stage) in enumerate(self.stages):
+            remaining = [stage.workers]
+            for _ in range(stage.workers):
+                threads.append(threading.Thread(target=self._run_stage, args=(stage, queues[k], queues[k + 1], remaining, stop),
+                                                daemon=True))
+        for thread in threads:
+            thread.start()
+        try:
+            self._run_sink(queues[-1], sink)
+        finally:
+            # the threads that are still blocked on a queue (sink failed) give up, the queued items are dropped
+            stop.set()
+            for thread in threads:
+                thread.join()
+            self.elapsed = time.perf_counter() - start
+
+
+    def _put(self, output, entry, stop):
+        # False if the pipeline was stopped while the queue was full
+        while not stop.is_set():
+            try:
+                output.put(entry, timeout=POLL_INTERVAL)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+
+    def _get(self, input, stop):
+        # None if the pipeline was stopped while the queue was empty
+        while not stop.is_set():
+            try:
+                return input.get(timeout=POLL_INTERVAL)
+            except queue.Empty:
+                pass
+        return None
+
+
+    def _run_source(self, source, output, stop):
+        sequence = 0
+        iterator = iter(source)
+        try:
+            while True:
+                begin = time.perf_counter()
+                try:
+                    item = next(iterator)
+                except StopIteration:
+                    break
+                except Exception as exception:
+                    self._put(output, (sequence, _Failure(exception)), stop)
+                    break
+                busy = time.perf_counter() - begin
+                begin = time.perf_counter()
+                if not self._put(output, (sequence, item), stop):
+                    return
+                self.source_stage.count(busy, 0.0, time.perf_counter() - begin)
+                sequence += 1
+            self._put(output, _DONE, stop)
+        finally:
+            if hasattr(iterator, 'close'): # e.g. the open blocks of a generator
+                iterator.close()
+
+
+    def _run_stage(self, stage, input, output, remaining, stop):
+        while True:
+            begin = time.perf_counter()
+            entry = self._get(input, stop)
+            waiting = time.perf_counter() - begin
+            if entry is None:
+                return
+            if entry is _DONE:
+                self._put(input, _DONE, stop) # for the other workers of this stage
+                with stage.lock:
+                    remaining[0] -= 1
+                    last = remaining[0] == 0
+                if last:
+                    self._put(output, _DONE, stop)
+                return
+            (sequence, item) = entry
+            begin = time.perf_counter()
+            if not isinstance(item, _Failure):
+                try:
+                    item = stage.function(item)
+                except Exception as exception:
+                    item = _Failure(exception)
+            busy = time.perf_counter() - begin
+            begin = time.perf_counter()
+            if not self._put(output, (sequence, item), stop):
+                return
+            stage.count(busy, waiting, time.perf_counter() - begin)
+
+
+    def _run_sink(self, input, sink):
+        # the workers can finish out of order, the items are handed to the sink in source order
+        pending = {}
+        next_sequence = 0
+        while True:
+            begin = time.perf_counter()
+            entry = input.get()
+            waiting = time.perf_counter() - begin
+            if entry is _DONE:
+                return
+            (sequence, item) = entry
+            pending[sequence] = item
+            while next_sequence in pending:
+                item = pending.pop(next_sequence)
+                if isinstance(item, _Failure):
+                    raise item.exception
+                begin = time.perf_counter()
+                sink(item)
+                self.sink_stage.count(time.perf_counter() - begin, waiting, 0.0)
+                waiting = 0.0
+                next_sequence += 1
+
+
+    def get_stats(self):
+        return [stage.get_stats(self.elapsed) for stage in [self.source_stage] + self.stages + [self.sink_stage]]
+
+
+    def log_stats(self):
+        for stats in self.get_stats():
+            logging.info('{stage:<10} workers {workers}  items {items:6d}  busy {busy_s:8.2f} s  '
+                         'waiting {waiting_s:8.2f} s  blocked {blocked_s:8.2f} s  utilization {utilization:4.0%}'.format(**stats))
@@ -0,0 +1,160 @@
+import os
+import json
+import numpy as np
+
+
+class ResultStore():
+    '''
+    streaming, array backed sink for the records of a sweep (one row per variation)
+    columns:
+    - number: variation number [n]
+    - components: component indices of the variation [n, depth]
+    - score: Evaluator.score() [n] or [n, n_metrics]
+    - feasible: Evaluator.screen() [n]
+    rows are buffered in chunks of chunk_size rows, with a path the chunks are appended to
+    <path>/<column>.bin (+ columns.json with the layout) and read back as read-only memmaps,
+    without a path they stay in memory
+    '''
+    COLUMNS = ('number', 'components', 'score', 'feasible')
+
+    def __init__(self, path = None, chunk_size = 2 ** 16):
+        self.path = path
+        self.chunk_size = chunk_size
+        self.layout = None # column -> (dtype, trailing shape)
+        self.buffer = {name: [] for name in self.COLUMNS}
+        self.buffered = 0
+        self.chunks = {name: [] for name in self.COLUMNS} # only used without a path
+        self.length = 0
+        if path:
+            os.makedirs(path, exist_ok=True)
+            self._load_layout()
+
+
+    def __len__(self):
+        return self.length
+
+
+    def _get_column_path(self, name):
+        return os.path.join(self.path, name + '.bin')
+
+
+    def _load_layout(self):
+        layout_path = os.path.join(self.path, 'columns.json')
+        if not os.path.exists(layout_path):
+            return
+        with open(layout_path) as f:
+            self.layout = {name: (np.dtype(dtype), tuple(shape)) for (name, (dtype, shape)) in json.load(f).items()}
+        (dtype, shape) = self.layout['number']
+        self.length = os.path.getsize(self._get_column_path('number')) // dtype.itemsize
+
+
+    def _init_layout(self, columns):
+        self.layout = {name: (columns[name].dtype, columns[name].shape[1:]) for name in self.COLUMNS}
+        if self.path:
+            with open(os.path.join(self.path, 'columns.json'), 'w') as f:
+                json.dump({name: (dtype.str, shape) for (name, (dtype, shape)) in self.layout.items()}, f)
+            for name in self.COLUMNS:
+                open(self._get_column_path(name), 'wb').close()
+
+
+    def append(self, numbers, components, scores, feasible):
+        columns = {
+            'number': np.asarray(numbers, dtype=np.int64),
+            'components': np.asarray(components, dtype=np.int32),
+            'score': np.asarray(scores, dtype=np.float64),
+            'feasible': np.asarray(feasible, dtype=bool),
+        }
+        if self.layout is None:
+            self._init_layout(columns)
+        for name in self.COLUMNS:
+            self.buffer[name].append(columns[name])
+        self.buffered += len(columns['number'])
+        self.length += len(columns['number'])
+        if self.buffered >= self.chunk_size:
+            self.flush()
+
+
+    def flush(self):
+        if not self.buffered:
+            return
+        for name in self.COLUMNS:
+            chunk = np.concatenate(self.buffer[name])
+            if self.path:
+                with open(self._get_column_path(name), 'ab') as f:
+                    f.write(np.ascontiguousarray(chunk).tobytes())
+            else:
+                self.chunks[name].append(chunk)
+            self.buffer[name] = []
+        self.buffered = 0
+
+
+    def clear(self):
+        self.buffer = {name: [] for name in self.COLUMNS}
+        self.buffered = 0
+        self.chunks = {name: [] for name in self.COLUMNS}
+        self.length = 0
+        if self.path and self.layout is not None:
+            # the next append() writes a new layout (the depth or the number of metrics may change)
+            for path in [self._get_column_path(name) for name in self.COLUMNS] + [os.path.join(self.path, 'columns.json')]:
+                if os.path.exists(path):
+                    os.remove(path)
+        self.layout = None
+
+
+    def truncate(self, next_number):
+        # drops all rows with number >= next_number (rows are stored in order), used when resuming
+        self.flush()
+        length = int(np.searchsorted(self.column('number'), next_number))
+        if length == self.length:
+            return
+        for name in self.COLUMNS:
+            if self.path:
+                (dtype, shape) = self.layout[name]
+                with open(self._get_column_path(name), 'r+b') as f:
+                    f.truncate(length * dtype.itemsize * int(np.prod(shape)))
+            else:
+                self.chunks[name] = [np.concatenate(self.chunks[name])[:length]]
+        self.length = length
+
+
+    def column(self, name):
+        '''
+        the whole column, a read-only memmap if the store has a path
+        '''
+        self.flush()
+        if self.layout is None:
+            return np.zeros(0)
+        (dtype, shape) = self.layout[name]
+        if not self.path:
+            return np.concatenate(self.chunks[name]) if self.chunks[name] else np.zeros((0,) + shape, dtype=dtype)
+        if self.length == 0:
+            return np.zeros((0,) + shape, dtype=dtype)
+        return np.memmap(self._get_column_path(name), dtype=dtype, mode='r', shape=(self.length,) + shape)
+
+
+    def top_k(self, k, metric = 0, feasible_only = True):
+        '''
+        variation numbers of the k rows with the lowest score (column metric of a multi column score)
+        the column is scanned chunk by chunk, so only O(k + chunk_size) is held in memory
+        '''
+        numbers = self.column('number')
+        scores = self.column('score')
+        feasible = self.column('feasible')
+        best_numbers = np.zeros(0, dtype=np.int64)
+        best_scores = np.zeros(0)
+        for first in range(0, len(numbers), self.chunk_size):
+            chunk = slice(first, first + self.chunk_size)
+            chunk_scores = np.asarray(scores[chunk])
+            if chunk_scores.ndim > 1:
+                chunk_scores = chunk_scores[:, metric]
+            chunk_numbers = np.asarray(numbers[chunk])
+            if feasible_only:
+                mask = np.asarray(feasible[chunk])
+                chunk_scores = chunk_scores[mask]
+                chunk_numbers = chunk_numbers[mask]
+            best_scores = np.concatenate([best_scores, chunk_scores])
+            best_numbers = np.concatenate([best_numbers, chunk_numbers])
+            order = np.lexsort((best_numbers, best_scores))[:k]
+            best_scores = best_scores[order]
+            best_numbers = best_numbers[order]
+        return best_numbers
@@ -0,0 +1,560 @@
+'''
+long-lived sweep service: keeps the harmonized component libraries warm and runs the sweep jobs of several
+users on one shared pool of worker processes, shard by shard and round robin between the users
+
+python service.py serve --socket /tmp/matching.sock     (or --port 8765 for tcp on localhost)
+python service.py submit job.json                       (streams the progress until the job is finished)
+python service.py status / watch <id> / cancel <id>
+
+protocol: one json request line per connection, the service answers with json event lines and closes it
+'''
+import os
+import json
+import time
+import pickle
+import asyncio
+import getpass
+import logging
+import argparse
+import itertools
+import threading
+from collections import OrderedDict, deque
+from concurrent.futures import Future, ThreadPoolExecutor
+from multiprocessing import Pool
+import skrf as rf
+from matchingsim import *
+from matchingsim import _init_worker, _run_worker, _worker_state
+
+DEFAULT_PORT = 8765
+PROGRESS_INTERVAL = 1.0 # seconds between two progress events of a running job
+MAX_LIBRARIES = 4 # warm libraries kept in memory, the least recently used one is dropped
+MAX_FINISHED_JOBS = 100 # status of the finished jobs that is kept
+WORKER_JOBS = 8 # worker states (engine, evaluator, ...) of the most recent jobs kept in every pool process
+# MatchingSimulationManager arguments a job may set (the service owns the processes, the shards always share prefixes)
+JOB_OPTIONS = ('batch_size', 'branch_and_bound', 'equivalence_tolerance', 'coarse_step', 'coarse_margin_db', 'dut_weights')
+FINAL_STATES = ('done', 'failed', 'cancelled')
+
+
+class JobEvaluator(BandEvaluator):
+    # the results are streamed as events, no log lines for every feasible candidate
+    def print_result(self, data):
+        pass
+
+
+class SweepJob():
+    '''
+    spec: json object of a sweep, e.g.
+    {"dut": "antenna/ellio-raw-dual.s1p", "topology": ["SERIES", "SHUNT", "SERIES"],
+     "bands": ["1700mhz-1900mhz"], "metrics": ["max_db", "min_db"], "limits": [[0, "min_db", -7], [0, "max_db", -3]],
+     "top_k": 10, "part_filter": {"size": "0402"}, "options": {"branch_and_bound": true}}
+    dut: a file or a list of files (dut states), top_k_metric: score column of the TopKCollector
+    the paths are relative to the working directory of the service
+    '''
+    def __init__(self, number, owner, spec):
+        self.number = number
+        self.owner = owner
+        self.spec = spec
+        self.dut_paths = spec['dut'] if isinstance(spec['dut'], list) else [spec['dut']]
+        self.topology = [CompKey[key.upper()] for key in spec['topology']]
+        self.bands = list(spec['bands'])
+        self.metrics = list(spec.get('metrics', ['max_db']))
+        self.limits = [tuple(limit) for limit in spec.get('limits', [])]
+        self.part_filter = spec.get('part_filter')
+        self.options = dict(spec.get('options', {}))
+        unknown = set(self.options) - set(JOB_OPTIONS)
+        if unknown:
+            raise ValueError('unknown job options: %s' % ', '.join(sorted(unknown)))
+        if not self.options.get('batch_size', 1):
+            raise ValueError('the shards need a batch_size')
+        self.collector = TopKCollector(int(spec.get('top_k', 10)), int(spec.get('top_k_metric', 0)))
+        self.state = 'queued' # -> loading -> running -> done / failed, or cancelled while queued
+        self.error = None
+        self.manager = None
+        self.status = None # final status, the manager is dropped when the job is finished
+        self.watchers = [] # asyncio.Queue of every connection that follows the job
+        self.submitted = time.time()
+        self.started = None
+        self.finished = None
+
+
+    def get_evaluator(self):
+        return JobEvaluator(self.bands, self.metrics, self.limits)
+
+
+    def get_status(self):
+        if self.status is not None:
+            return self.status
+        status = {'id': self.number, 'owner': self.owner, 'state': self.state, 'error': self.error,
+                  'queued_s': (self.started or time.time()) - self.submitted}
+        manager = self.manager
+        if manager is not None and self.state != 'loading':
+            metrics = manager.metrics
+            status.update(done=metrics.done, total=metrics.total, variations_per_s=metrics.get_rate(),
+                          eta_s=metrics.get_eta(), elapsed_s=metrics.get_elapsed())
+            variation_space = manager.network_library.variation_space
+            status['top'] = [{'number': number, 'score': score, 'parts': [component.name for component in variation_space[number]]}
+                             for (number, score) in self.collector.results()]
+        return status
+
+
+    def finish(self, state, error = None):
+        self.state = state
+        self.error = error
+        self.finished = time.time()
+        self.status = self.get_status()
+        self.manager = None
+
+
+class FairQueue():
+    '''
+    round robin between the owners of the queued jobs, first in first out per owner:
+    the next job is the one of the owner whose last job was started the longest time ago (or never),
+    ten sweeps queued by one user don't hold back the single sweep of another one
+    the ShardScheduler queues the running jobs the same way, every pop() is one shard
+    '''
+    def __init__(self):
+        self.queues = OrderedDict() # owner -> deque of jobs
+        self.served = {} # owner -> number of the pop() that started the last job of the owner
+        self.pops = itertools.count()
+
+
+    def __len__(self):
+        return sum(len(queue) for queue in self.queues.values())
+
+
+    def push(self, job, first = False):
+        # first: ahead of the other jobs of the owner (e.g. the job that got the last shard)
+        queue = self.queues.setdefault(job.owner, deque())
+        if first:
+            queue.appendleft(job)
+        else:
+            queue.append(job)
+
+
+    def pop(self):
+        owner = min(self.queues, key=lambda owner: self.served.get(owner, -1))
+        queue = self.queues[owner]
+        job = queue.popleft()
+        if not queue:
+            del self.queues[owner]
+        self.served[owner] = next(self.pops)
+        return job
+
+
+    def remove(self, job):
+        queue = self.queues.get(job.owner)
+        if queue is None or job not in queue:
+            return False
+        queue.remove(job)
+        if not queue:
+            del self.queues[job.owner]
+        return True
+
+
+class _ShardStream():
+    # the shards of one job in the ShardScheduler
+    def __init__(self, key, owner, worker_args, tasks):
+        self.key = key
+        self.owner = owner
+        self.state = pickle.dumps(worker_args) # sent with every shard, unpickled once per job and pool process
+        self.tasks = iter(tasks)
+        self.pending = deque() # (task, AsyncResult) in the order of the tasks
+        self.exhausted = False
+
+
+class ShardScheduler():
+    '''
+    one multiprocessing.Pool for the shards (MatchingNetworkLibrary.iter_shards()) of all running jobs
+    - at most 2 shards per process are in flight, a slot is given to the next job of the FairQueue,
+      so the users get the processes round robin shard by shard, not job by job
+    - a shard carries the pickled _init_worker() arguments of its job (small with a LibraryCache,
+      the engine is pickled as the path of its memmap), the pool processes keep the state of the
+      last WORKER_JOBS jobs and run _run_worker() on it
+    imap() is called from the thread of a job (MatchingSimulationManager pool=, see JobShards)
+    '''
+    def __init__(self, processes = None):
+        self.processes = processes or os.cpu_count()
+        self.window = 2 * self.processes
+        self.pool = Pool(self.processes)
+        self.queue = FairQueue() # _ShardStream of every job with shards that were not submitted yet
+        self.condition = threading.Condition() # guards queue, in_flight and the pending shards of the streams
+        self.in_flight = 0 # submitted and not yet taken by the job
+
+
+    def imap(self, key, owner, worker_args, tasks):
+        # yields (task, _run_worker(task)) in the order of tasks
+        stream = _ShardStream(key, owner, worker_args, tasks)
+        with self.condition:
+            self.queue.push(stream)
+            self._fill()
+        try:
+            while True:
+                with self.condition:
+                    while not stream.pending and not stream.exhausted:
+                        self.condition.wait()
+                    if not stream.pending:
+                        return
+                    (task, result) = stream.pending.popleft()
+                value = result.get()
+                with self.condition:
+                    self.in_flight -= 1
+                    self._fill()
+                yield (task, value)
+        finally:
+            with self.condition:
+                # a failed job: the shards that are still running are not waited for
+                self.queue.remove(stream)
+                self.in_flight -= len(stream.pending)
+                stream.pending.clear()
+                self._fill()
+
+
+    def _fill(self):
+        # with the condition held
+        while self.in_flight < self.window and self.queue:
+            stream = self.queue.pop()
+            task = next(stream.tasks, None)
+            if task is None:
+                stream.exhausted = True
+                continue
+            result = self.pool.apply_async(_run_shard, ((stream.key, stream.state) + tuple(task),))
+            stream.pending.append((task, result))
+            self.in_flight += 1
+            self.queue.push(stream, first=True)
+        self.condition.notify_all()
+
+
+    def close(self):
+        self.pool.terminate()
+
+
+class JobShards():
+    # the pool of the MatchingSimulationManager of a job: its shards go through the ShardScheduler
+    def __init__(self, scheduler, job):
+        self.scheduler = scheduler
+        self.job = job
+
+    def imap(self, worker_args, tasks):
+        return self.scheduler.imap(self.job.number, self.job.owner, worker_args, tasks)
+
+
+# worker states of the pool processes of a ShardScheduler: job -> _worker_state, least recently used first
+_worker_jobs = OrderedDict()
+
+def _run_shard(task):
+    (key, state, start, stop) = task
+    worker_state = _worker_jobs.pop(key, None)
+    if worker_state is None:
+        _worker_state.clear()
+        _init_worker(*pickle.loads(state))
+        worker_state = dict(_worker_state)
+    _worker_jobs[key] = worker_state
+    while len(_worker_jobs) > WORKER_JOBS:
+        _worker_jobs.popitem(last=False)
+    _worker_state.clear()
+    _worker_state.update(worker_state)
+    return _run_worker((start, stop))
+
+
+class SweepService():
+    '''
+    runs up to workers jobs at a time in threads (loading, evaluate() of the candidates, progress),
+    the jobs are started in the order of the FairQueue, their shards run on the processes of the ShardScheduler
+    the harmonized libraries are kept in memory per (part_filter, dut grids), a job with a known key forks the warm
+    library (MatchingNetworkLibrary.fork()) instead of reading and resampling the component files,
+    cache: LibraryCache for the first load of a library (e.g. after a restart)
+    a job only keeps its TopKCollector, the records of the variations are not stored
+    '''
+    def __init__(self, workers = None, series_dir = None, shunt_dir = None, cache = None, index_path = None,
+                 max_libraries = MAX_LIBRARIES, processes = None):
+        self.workers = workers or os.cpu_count()
+        self.scheduler = ShardScheduler(processes) # first, the pool processes are forked before any thread is started
+        self.series_dir = series_dir
+        self.shunt_dir = shunt_dir
+        self.cache = cache
+        self.index_path = index_path
+        self.max_libraries = max_libraries
+        self.executor = ThreadPoolExecutor(self.workers)
+        self.queue = FairQueue()
+        self.jobs = OrderedDict() # id -> SweepJob
+        self.running = 0
+        self.tasks = set() # keeps the running job tasks alive
+        self.libraries = OrderedDict() # key -> Future of an initialized MatchingNetworkLibrary, least recently used first
+        self.library_lock = threading.Lock() # guards libraries, the loads run outside of it
+        self.numbers = itertools.count(1)
+
+
+    def get_library(self, duts, part_filter = None):
+        # warm library for the duts (same grids -> same common grid) and the part filter, loaded on a miss
+        # the first job with a key loads it outside of the lock, the other jobs with that key wait for its future
+        key = (json.dumps(part_filter, sort_keys=True), tuple(dut.frequency.f.tobytes() for dut in duts))
+        with self.library_lock:
+            future = self.libraries.get(key)
+            load = future is None
+            if load:
+                future = self.libraries[key] = Future()
+                while len(self.libraries) > self.max_libraries:
+                    self.libraries.popitem(last=False)
+            else:
+                self.libraries.move_to_end(key)
+        if not load:
+            return future.result() # waits for the load, raises its error if it failed
+        try:
+            start = time.time()
+            library = MatchingNetworkLibrary(self.series_dir, self.shunt_dir, self.cache, part_filter, self.index_path)
+            library.init_components(duts)
+            logging.info('library of %d components loaded in %.2f s' % (len(library.components), time.time() - start))
+        except Exception as error:
+            with self.library_lock:
+                if self.libraries.get(key) is future: # the next job tries again
+                    del self.libraries[key]
+            future.set_exception(error)
+            raise
+        future.set_result(library)
+        return library
+
+
+    def submit(self, owner, spec):
+        job = SweepJob(next(self.numbers), owner, spec)
+        self.jobs[job.number] = job
+        self.queue.push(job)
+        logging.info('job %d of %s queued' % (job.number, owner))
+        self._dispatch()
+        return job
+
+
+    def cancel(self, job):
+        # only queued jobs can be cancelled
+        if not self.queue.remove(job):
+            return False
+        job.finish('cancelled')
+        self._publish(job, 'cancelled', final=True)
+        return True
+
+
+    def _dispatch(self):
+        while self.running < self.workers and self.queue:
+            job = self.queue.pop()
+            self.running += 1
+            task = asyncio.get_running_loop().create_task(self._run(job))
+            self.tasks.add(task)
+            task.add_done_callback(self.tasks.discard)
+
+
+    async def _run(self, job):
+        job.started = time.time()
+        job.state = 'loading'
+        future = asyncio.get_running_loop().run_in_executor(self.executor, self._run_job, job)
+        try:
+            while not (await asyncio.wait([future], timeout=PROGRESS_INTERVAL))[0]:
+                self._publish(job, 'progress')
+            future.result()
+            job.finish('done')
+        except Exception as error:
+            logging.exception('job %d failed' % job.number)
+            job.finish('failed', str(error) or repr(error))
+        finally:
+            self.running -= 1
+            self._publish(job, job.state, final=True)
+            self._forget_finished()
+            self._dispatch()
+
+
+    def _run_job(self, job):
+        # worker thread
+        duts = [rf.Network(path) for path in job.dut_paths]
+        library = self.get_library(duts, job.part_filter)
+        job.manager = MatchingSimulationManager(duts if len(duts) > 1 else duts[0], job.get_evaluator(), job.topology,
+                                                collectors=[job.collector], library=library,
+                                                pool=JobShards(self.scheduler, job), **job.options)
+        job.state = 'running'
+        job.manager.simulate()
+
+
+    def _publish(self, job, event, final = False):
+        message = dict(job.get_status(), event=event)
+        for watcher in job.watchers:
+            watcher.put_nowait(message)
+            if final:
+                watcher.put_nowait(None)
+        if final:
+            job.watchers = []
+
+
+    def _forget_finished(self):
+        finished = [number for (number, job) in self.jobs.items() if job.state in FINAL_STATES]
+        for number in finished[:max(len(finished) - MAX_FINISHED_JOBS, 0)]:
+            del self.jobs[number]
+
+
+    async def serve(self, path = None, host = '127.0.0.1', port = DEFAULT_PORT):
+        # unix socket with a path, else tcp
+        if path:
+            server = await asyncio.start_unix_server(self.handle, path)
+        else:
+            server = await asyncio.start_server(self.handle, host, port)
+        logging.info('sweep service listening on %s with %d workers and %d processes' % (
+            path or '%s:%d' % (host, port), self.workers, self.scheduler.processes))
+        async with server:
+            await server.serve_forever()
+
+
+    async def handle(self, reader, writer):
+        try:
+            line = await reader.readline()
+            try:
+                await self._handle_request(json.loads(line), writer)
+            except (ValueError, KeyError, TypeError) as error:
+                await _send(writer, {'event': 'error', 'message': '%s: %s' % (type(error).__name__, error)})
+        except ConnectionError:
+            pass
+        finally:
+            writer.close()
+
+
+    async def _handle_request(self, request, writer):
+        '''
+        {"op": "submit", "job": {...}, "owner": "name", "follow": true}: queued + progress events until the job is finished
+        {"op": "watch", "id": 1}: the same for a submitted job
+        {"op": "status"} / {"op": "status", "id": 1}: status of all jobs / of one
+        {"op": "cancel", "id": 1}: cancels a queued job
+        '''
+        op = request['op']
+        if op == 'submit':
+            job = self.submit(request.get('owner', 'anonymous'), request['job'])
+            if request.get('follow', True):
+                await self._follow(job, writer, 'queued')
+            else:
+                await _send(writer, dict(job.get_status(), event='queued'))
+        elif op == 'watch':
+            await self._follow(self.jobs[int(request['id'])], writer, 'status')
+        elif op == 'status':
+            if 'id' in request:
+                await _send(writer, dict(self.jobs[int(request['id'])].get_status(), event='status'))
+            else:
+                await _send(writer, {'event': 'status', 'running': self.running, 'queued': len(self.queue),
+                                     'libraries': len(self.libraries), 'jobs': [job.get_status() for job in self.jobs.values()]})
+        elif op == 'cancel':
+            job = self.jobs[int(request['id'])]
+            if self.cancel(job):
+                await _send(writer, dict(job.get_status(), event='cancelled'))
+            else:
+                await _send(writer, {'event': 'error', 'message': 'job %d is %s' % (job.number, job.state)})
+        else:
+            raise ValueError('unknown op %r' % op)
+
+
+    async def _follow(self, job, writer, event):
+        await _send(writer, dict(job.get_status(), event=event))
+        if job.state in FINAL_STATES:
+            return
+        watcher = asyncio.Queue()
+        job.watchers.append(watcher)
+        try:
+            while True:
+                message = await watcher.get()
+                if message is None:
+                    return
+                await _send(writer, message)
+        finally:
+            if watcher in job.watchers:
+                job.watchers.remove(watcher)
+
+
+async def _send(writer, message):
+    writer.write(json.dumps(message).encode() + b'\n')
+    await writer.drain()
+
+
+async def request(message, path = None, host = '127.0.0.1', port = DEFAULT_PORT):
+    # sends one request to a running service, yields the events of the answer
+    if path:
+        (reader, writer) = await asyncio.open_unix_connection(path)
+    else:
+        (reader, writer) = await asyncio.open_connection(host, port)
+    try:
+        writer.write(json.dumps(message).encode() + b'\n')
+        await writer.drain()
+        while True:
+            line = await reader.readline()
+            if not line:
+                return
+            yield json.loads(line)
+    finally:
+        writer.close()
+
+
+def get_event_str(event):
+    if 'jobs' in event:
+        return '%d running, %d queued, %d warm libraries' % (event['running'], event['queued'], event['libraries'])
+    if event.get('event') == 'error':
+        return 'error: ' + event['message']
+    text = 'job %d (%s) %s' % (event['id'], event['owner'], event['state'])
+    if event.get('total'):
+        eta = event['eta_s']
+        text += ': %d of %d (%.0f variations/s, eta %s)' % (event['done'], event['total'], event['variations_per_s'],
+                                                            'n/a' if eta is None else '%.0f s' % eta)
+    if event.get('error'):
+        text += ': ' + event['error']
+    return text
+
+
+async def run_client(args, message):
+    async for event in request(message, args.socket, args.host, args.port):
+        if args.json:
+            print(json.dumps(event))
+            continue
+        print(get_event_str(event))
+        for job in event.get('jobs', ()):
+            print('  ' + get_event_str(job))
+        if event['event'] in FINAL_STATES:
+            for (rank, entry) in enumerate(event.get('top') or (), 1):
+                print('  %2d. %10d  %s  %s' % (rank, entry['number'], entry['score'], ' + '.join(entry['parts'])))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='sweep service with warm component libraries')
+    parser.add_argument('--socket', help='unix socket (default: tcp on --host/--port)')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=DEFAULT_PORT)
+    commands = parser.add_subparsers(dest='command', required=True)
+    serve = commands.add_parser('serve')
+    serve.add_argument('--workers', type=int, help='concurrent jobs (default: number of cpus)')
+    serve.add_argument('--processes', type=int, help='pool processes for the shards of all jobs (default: number of cpus)')
+    serve.add_argument('--cache', default='cache', help='LibraryCache directory, empty for none')
+    serve.add_argument('--series-dir')
+    serve.add_argument('--shunt-dir')
+    serve.add_argument('--index', help='ComponentIndex file for the part filters')
+    submit = commands.add_parser('submit')
+    submit.add_argument('job', help='json file with the job spec (see SweepJob)')
+    submit.add_argument('--owner', default=getpass.getuser())
+    submit.add_argument('--no-follow', action='store_true')
+    status = commands.add_parser('status')
+    status.add_argument('id', type=int, nargs='?')
+    for name in ('watch', 'cancel'):
+        commands.add_parser(name).add_argument('id', type=int)
+    for command in (submit, status) + tuple(commands.choices[name] for name in ('watch', 'cancel')):
+        command.add_argument('--json', action='store_true', help='print the raw events')
+    args = parser.parse_args()
+
+    if args.command == 'serve':
+        logging.basicConfig(level=os.environ.get('LOGLEVEL', 'INFO'))
+        service = SweepService(args.workers, args.series_dir, args.shunt_dir, LibraryCache(args.cache) if args.cache else None,
+                               args.index, processes=args.processes)
+        try:
+            asyncio.run(service.serve(args.socket, args.host, args.port))
+        finally:
+            service.scheduler.close()
+        return
+    if args.command == 'submit':
+        with open(args.job) as f:
+            message = {'op': 'submit', 'job': json.load(f), 'owner': args.owner, 'follow': not args.no_follow}
+    elif args.command == 'status' and args.id is None:
+        message = {'op': 'status'}
+    else:
+        message = {'op': args.command, 'id': args.id}
+    asyncio.run(run_client(args, message))
+
+
+if __name__ == '__main__':
+    main()
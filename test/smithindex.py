@@ -0,0 +1,55 @@
+import numpy as np
+from scipy.spatial import cKDTree
+from cascade import CascadeEngine
+
+
+class SmithIndex():
+    '''
+    meet in the middle pre-selection for pointwise limits of |S11| (see ReflectionBound.get_pointwise_limit())
+    the slots are split into a front half (source side) and a back half (dut side):
+    - back: every combination of the back slots is cascaded with the dut once, which gives its reflection
+      coefficient at the split [n_back, n_points]
+    - front: every combination of the front slots gives the disk of loads at the split that keep |S11|
+      at the input below the limit (CascadeEngine.get_load_region()) [n_front, n_points]
+    - a variation can only meet the limit if the reflection of its back lies in the disk of its front at
+      every point, kd-trees over the backs at a few sample points give the candidates of every front,
+      which are then checked at all points
+    only the survivors have to be cascaded and evaluated, instead of n_front * n_back variations
+    '''
+    def __init__(self, engine, gamma_load, limit, samples = 8):
+        self.points = np.flatnonzero(np.isfinite(limit)) # only the constrained points matter
+        self.limit = limit[self.points] + 1e-9 # slack for rounding errors
+        self.engine = CascadeEngine(None, None, z0=engine.z0, abcd=engine.abcd[:, self.points])
+        self.gamma_load = gamma_load[self.points]
+        self.samples = np.unique(np.linspace(0, len(self.points) - 1, samples).astype(int))
+
+
+    def iter_candidates(self, index_lists):
+        '''
+        index_lists: component indices of every slot
+        yields arrays of positions in the cartesian product of index_lists (itertools.product order)
+        that can meet the limit, one array per front combination in ascending order
+        '''
+        split = len(index_lists) // 2
+        back = self.engine.terminate(self.engine.cascade_product(index_lists[split:]), self.gamma_load)
+        if split == 0:
+            front = np.broadcast_to(np.eye(2, dtype=complex), (1, len(self.points), 2, 2))
+        else:
+            front = self.engine.cascade_product(index_lists[:split])
+        (centers, radii) = self.engine.get_load_region(front, self.limit)
+
+        trees = [cKDTree(np.column_stack([back[:, k].real, back[:, k].imag])) for k in self.samples]
+        all_backs = np.arange(len(back))
+        for number in range(len(front)):
+            sample_radii = radii[number, self.samples]
+            best = int(np.argmin(sample_radii))
+            if np.isfinite(sample_radii[best]):
+                center = centers[number, self.samples[best]]
+                candidates = np.array(sorted(trees[best].query_ball_point([center.real, center.imag], sample_radii[best])), dtype=np.intp)
+            else:
+                candidates = all_backs
+            if len(candidates) == 0:
+                continue
+            inside = np.all(np.abs(back[candidates] - centers[number]) <= radii[number], axis=1)
+            if inside.any():
+                yield number * len(back) + candidates[inside]
@@ -0,0 +1,99 @@
+import logging
+import numpy as np
+import pytest
+from benchmark import generate_library
+from matchingsim import *
+from matchingsim import _specific_order_cartesian
+
+# 3 L + 3 C parts per topology, SERIES, SHUNT, SERIES -> 6 * 6 * 6 variations
+DESCRIPTION = [CompKey.SERIES, CompKey.SHUNT, CompKey.SERIES]
+BANDS = ['791mhz-861mhz', '1710mhz-1880mhz']
+METRICS = ['max_db', 'min_db', 'mean_db']
+LIMITS = {
+    'max_db': [(0, 'max_db', -0.6)], # pointwise, also used by meet in the middle
+    'mixed': [(0, 'max_db', -0.3), (0, 'min_db', -0.9), (1, 'mean_db', -0.3)],
+}
+MODES = {
+    'networks': dict(batch_size=None),
+    'prefix_sharing': dict(prefix_sharing=True),
+    'branch_and_bound': dict(branch_and_bound=True),
+    'pipeline': dict(pipeline=True),
+    'parallel': dict(processes=2),
+    'parallel_branch_and_bound': dict(processes=2, branch_and_bound=True),
+    'meet_in_the_middle': dict(meet_in_the_middle=True),
+    'coarse': dict(coarse_step=8),
+    'coarse_branch_and_bound': dict(coarse_step=8, branch_and_bound=True),
+    'coarse_parallel': dict(coarse_step=8, processes=2),
+}
+
+
+@pytest.fixture(scope='module')
+def library_root(tmp_path_factory):
+    root = tmp_path_factory.mktemp('library')
+    logging.disable(logging.WARNING)
+    dut = generate_library(str(root), 3, 801, 700, 2000, True)
+    yield (root, dut)
+    logging.disable(logging.NOTSET)
+
+
+def run(library_root, limits, **options):
+    (root, dut) = library_root
+    options.setdefault('processes', 1)
+    manager = MatchingSimulationManager(dut, BandEvaluator(BANDS, METRICS, limits), DESCRIPTION, result_store=ResultStore(),
+                                        series_dir=str(root / 'components' / 'series'),
+                                        shunt_dir=str(root / 'components' / 'shunt'), **options)
+    (result, feasible_results) = manager.simulate()
+    return (manager, sorted(feasible_results.numbers))
+
+
+@pytest.fixture(scope='module')
+def reference(library_root):
+    # the plain batched sweep: (manager, feasible numbers) per limit set
+    return {name: run(library_root, limits) for (name, limits) in LIMITS.items()}
+
+
+def test_variation_space_matches_specific_order_cartesian(library_root, reference):
+    library = reference['max_db'][0].network_library
+    space = library.variation_space
+    variations = list(_specific_order_cartesian(library.variation_template))
+    assert len(space) == len(variations) == 216
+    assert list(space) == variations
+    for (number, variation) in enumerate(variations):
+        assert space[number] == variation
+        assert space.index_of(variation) == number
+    assert list(space.iter_range(100, 120)) == variations[100:120]
+
+
+def test_reference_is_not_trivial(reference):
+    for (manager, feasible) in reference.values():
+        assert 0 < len(feasible) < len(manager.network_library.variation_space)
+
+
+@pytest.mark.parametrize('limits', list(LIMITS))
+@pytest.mark.parametrize('mode', list(MODES))
+def test_modes_find_the_same_feasible_set(library_root, reference, limits, mode):
+    (reference_manager, reference_feasible) = reference[limits]
+    (manager, feasible) = run(library_root, LIMITS[limits], **MODES[mode])
+    assert feasible == reference_feasible
+    if manager.batch_size is None:
+        return
+    # the rows that were scored (not pruned / screened out) have the scores of the full sweep
+    store = manager.result_store
+    scores = store.column('score')
+    scored = ~np.isnan(scores).any(axis=1)
+    if manager.coarse is not None:
+        assert not scored.all() # the coarse screen did reject something
+    expected = reference_manager.result_store.column('score')[store.column('number')[scored]]
+    assert np.allclose(scores[scored], expected, rtol=0, atol=1e-9)
+    assert np.array_equal(store.column('feasible'), np.isin(store.column('number'), reference_feasible))
+
+
+def test_bound_never_prunes_a_feasible_variation(reference):
+    # ReflectionBound.prune() on the exact |S11| of every feasible variation (the tightest possible lower bound)
+    for (manager, feasible) in reference.values():
+        bound = manager.evaluator.get_bound(manager.network_library.frequency)
+        library = manager.network_library
+        for number in feasible:
+            indices = [[component.index for component in library.variation_space[number]]]
+            s11 = library.engine.evaluate(indices, manager.gamma_load)[0]
+            assert not bound.prune(np.abs(s11))
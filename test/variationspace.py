@@ -0,0 +1,159 @@
+from bisect import bisect_right
+from itertools import product
+
+
+class VariationSpace():
+    '''
+    random access to the variations of _specific_order_cartesian(template)
+    the specific order is a sequence of plain cartesian products ("blocks"),
+    in every block each slot covers a contiguous range of positions of its list:
+    - the slot that introduces a new column c is fixed at c
+    - the slots after it cover 0..c, the slots before it 0..c-1 (as far as their lists go)
+    so len(), space[i] and index_of() only need a bisect over the block starts + O(depth) arithmetic
+    '''
+    def __init__(self, template):
+        self.template = template # [[element]] for every slot
+        self.positions = [{element: position for (position, element) in reversed(list(enumerate(slot)))} for slot in template]
+        self.block_starts = []
+        self.block_ranges = [] # [(first, stop)] for every slot
+        self.block_numbers = {} # (column, slot) -> block number
+        self.size = 0
+        self._init_blocks()
+
+
+    def _init_blocks(self):
+        lengths = [len(slot) for slot in self.template]
+        its_lengths = [1] * len(lengths)
+        self._add_block(None, [(0, 1)] * len(lengths))
+        for column in range(1, max(lengths)):
+            for i in reversed(range(len(lengths))):
+                if column >= lengths[i]:
+                    continue
+                ranges = [(column, column + 1) if j == i else (0, its_lengths[j]) for j in range(len(lengths))]
+                self._add_block((column, i), ranges)
+                its_lengths[i] += 1
+
+
+    def _add_block(self, key, ranges):
+        self.block_numbers[key] = len(self.block_starts)
+        self.block_starts.append(self.size)
+        self.block_ranges.append(ranges)
+        self.size += _get_ranges_size(ranges)
+
+
+    def __len__(self):
+        return self.size
+
+
+    def __iter__(self):
+        return self.iter_range(0, self.size)
+
+
+    def __getitem__(self, key):
+        if isinstance(key, slice):
+            numbers = range(self.size)[key]
+            if numbers.step == 1:
+                return list(self.iter_range(numbers.start, numbers.stop))
+            return [self[i] for i in numbers]
+
+        if key < 0:
+            key += self.size
+        if key < 0 or key >= self.size:
+            raise IndexError('variation index out of range')
+        block = bisect_right(self.block_starts, key) - 1
+        n = key - self.block_starts[block]
+        positions = []
+        for (first, stop) in reversed(self.block_ranges[block]):
+            (n, position) = divmod(n, stop - first)
+            positions.append(first + position)
+        return tuple(slot[position] for (slot, position) in zip(self.template, reversed(positions)))
+
+
+    def index_of(self, variation):
+        '''
+        inverse of space[i]
+        '''
+        if len(variation) != len(self.template):
+            raise ValueError('variation does not match the template')
+        try:
+            positions = [self.positions[j][element] for (j, element) in enumerate(variation)]
+        except KeyError:
+            raise ValueError('variation is not part of the variation space')
+        column = max(positions)
+        key = None if column == 0 else (column, positions.index(column))
+        block = self.block_numbers[key]
+        n = 0
+        for (position, (first, stop)) in zip(positions, self.block_ranges[block]):
+            if not first <= position < stop:
+                raise ValueError('variation is not part of the variation space')
+            n = n * (stop - first) + position - first
+        return self.block_starts[block] + n
+
+
+    def iter_range(self, start, stop):
+        # variations start..stop-1 in order
+        for (_, block) in self.iter_blocks(start, stop):
+            yield from product(*block)
+
+
+    def iter_blocks(self, start = 0, stop = None):
+        '''
+        variations start..stop-1 as consecutive plain cartesian products
+        (blocks cut by start/stop are split into O(depth) smaller products)
+        yields (number of the first variation, [[element]] for every slot)
+        '''
+        for (block_start, ranges) in self.iter_block_ranges(start, stop):
+            yield (block_start, [slot[first:last] for (slot, (first, last)) in zip(self.template, ranges)])
+
+
+    def iter_block_ranges(self, start = 0, stop = None):
+        # same as iter_blocks() but yields the position ranges instead of the elements
+        if stop is None or stop > self.size:
+            stop = self.size
+        if start >= stop:
+            return
+        block = bisect_right(self.block_starts, start) - 1
+        while block < len(self.block_starts) and self.block_starts[block] < stop:
+            block_start = self.block_starts[block]
+            ranges = self.block_ranges[block]
+            size = _get_ranges_size(ranges)
+            for (offset, sub_ranges) in _iter_sub_ranges(ranges, max(start - block_start, 0), min(stop - block_start, size)):
+                yield (block_start + offset, sub_ranges)
+            block += 1
+
+
+def _get_ranges_size(ranges):
+    size = 1
+    for (first, stop) in ranges:
+        size *= stop - first
+    return size
+
+
+# splits the variations a..b-1 of product(*ranges) into consecutive products
+# yields (offset of the first variation, ranges)
+def _iter_sub_ranges(ranges, a, b):
+    if a >= b:
+        return
+    size = _get_ranges_size(ranges)
+    if a == 0 and b == size:
+        yield (0, list(ranges))
+        return
+
+    (first, stop) = ranges[0]
+    rest = size // (stop - first)
+    (a_0, a_rest) = divmod(a, rest)
+    (b_0, b_rest) = divmod(b, rest)
+    if a_0 == b_0:
+        for (offset, sub_ranges) in _iter_sub_ranges(ranges[1:], a_rest, b_rest):
+            yield (a_0 * rest + offset, [(first + a_0, first + a_0 + 1)] + sub_ranges)
+        return
+
+    if a_rest:
+        for (offset, sub_ranges) in _iter_sub_ranges(ranges[1:], a_rest, rest):
+            yield (a_0 * rest + offset, [(first + a_0, first + a_0 + 1)] + sub_ranges)
+        a_0 += 1
+    if a_0 < b_0:
+        yield (a_0 * rest, [(first + a_0, first + b_0)] + list(ranges[1:]))
+    if b_rest:
+        for (offset, sub_ranges) in _iter_sub_ranges(ranges[1:], 0, b_rest):
+            yield (b_0 * rest + offset, [(first + b_0, first + b_0 + 1)] + sub_ranges)
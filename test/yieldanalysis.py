@@ -0,0 +1,148 @@
+import numpy as np
+from partindex import PartIndex
+
+
+class YieldAnalysis():
+    '''
+    monte carlo tolerance analysis of single variations (e.g. the shortlist of a sweep):
+    every part of a variation is perturbed samples times, the perturbed cascades are terminated into
+    the dut in batches and passed to Evaluator.screen(), the pass rate is the yield of the variation
+    - inductors: L * (1 + u), u within +-l_tolerance (relative)
+    - capacitors: C + u, u within +-c_tolerance (farad)
+    the parts are classified by PartIndex, by default the measured series impedance (shunt admittance)
+    of a part is scaled with the perturbed value (the parasitics are scaled along for inductors, a
+    capacitor gets the extra capacitance in parallel)
+    interpolate: blend the matrices of the two library parts of the same kind whose nominal values enclose
+    the perturbed value instead (falls back to scaling outside of the library range)
+    distribution: 'uniform', or 'normal' with the tolerance as 3 sigma
+    only the perturbed entries of the matrices are expanded to [samples, n_freq], the 2x2 products of the
+    cascade are written out element wise (several times faster than matmuls of the full sample stacks)
+    '''
+    def __init__(self, samples = 1000, l_tolerance = 0.02, c_tolerance = 0.1e-12, interpolate = False,
+                 distribution = 'uniform', batch_size = 256, seed = 0):
+        self.samples = samples
+        self.l_tolerance = l_tolerance
+        self.c_tolerance = c_tolerance
+        self.interpolate = interpolate
+        self.distribution = distribution
+        self.batch_size = batch_size
+        self.seed = seed
+        self.part_index = None
+        self._library = None
+
+
+    def run(self, library, evaluator, gamma_load, numbers):
+        '''
+        library: MatchingNetworkLibrary, numbers: variation numbers to analyze
+        gamma_load: [n_freq] or [n_states, n_freq] for several duts (with a StateEvaluator)
+        returns [{'number', 'samples', 'passed', 'pass_rate', 'nominal_pass', 'worst_score'}] in the order of numbers
+        '''
+        if self._library is not library:
+            self.part_index = PartIndex(library)
+            self._library = library
+        rng = np.random.default_rng(self.seed)
+        results = []
+        for number in numbers:
+            variation = library.variation_space[int(number)]
+            results.append(self.analyze(library.engine, evaluator, gamma_load, int(number), variation, rng))
+        return results
+
+
+    def analyze(self, engine, evaluator, gamma_load, number, variation, rng):
+        indices = [component.index for component in variation]
+        nominal = engine.evaluate([indices], gamma_load)
+        nominal_pass = bool(np.asarray(evaluator.screen([number], nominal, engine.frequency))[0])
+        passed = 0
+        worst_score = None
+        for first in range(0, self.samples, self.batch_size):
+            size = min(self.batch_size, self.samples - first)
+            (a, b, c, d) = self._perturb(engine, indices[0], size, rng)
+            for index in indices[1:]:
+                (e, f, g, h) = self._perturb(engine, index, size, rng)
+                (a, b, c, d) = (a * e + b * g, a * f + b * h, c * e + d * g, c * f + d * h)
+            abcd = np.empty((size, 2, 2, len(engine.frequency)), dtype=complex) # frequency innermost like s2a()
+            (abcd[:, 0, 0], abcd[:, 0, 1], abcd[:, 1, 0], abcd[:, 1, 1]) = (a, b, c, d)
+            s11 = engine.terminate(abcd.transpose(0, 3, 1, 2), gamma_load)
+            batch_numbers = np.full(size, number)
+            passed += int(np.count_nonzero(evaluator.screen(batch_numbers, s11, engine.frequency)))
+            scores = np.asarray(evaluator.score(batch_numbers, s11, engine.frequency), dtype=float)
+            batch_worst = scores.max(axis=0)
+            worst_score = batch_worst if worst_score is None else np.maximum(worst_score, batch_worst)
+        return {
+            'number': number,
+            'samples': self.samples,
+            'passed': passed,
+            'pass_rate': passed / self.samples if self.samples else 0.0,
+            'nominal_pass': nominal_pass,
+            'worst_score': None if worst_score is None else np.atleast_1d(worst_score).tolist(),
+        }
+
+
+    def _get_deviations(self, tolerance, size, rng):
+        if self.distribution == 'normal':
+            return np.clip(rng.normal(0, tolerance / 3, size), -tolerance, tolerance)
+        return rng.uniform(-tolerance, tolerance, size)
+
+
+    def _perturb(self, engine, index, size, rng):
+        # entries (a, b, c, d) of the perturbed matrices of part index, each [size, n_freq] or broadcastable to it
+        part_index = self.part_index
+        inductor = part_index.kinds[index] == 'L'
+        value = part_index.values[index]
+        if inductor:
+            values = value * (1 + self._get_deviations(self.l_tolerance, size, rng))
+        else:
+            values = value + self._get_deviations(self.c_tolerance, size, rng)
+            values = np.maximum(values, value * 1e-3) # no negative capacitances for tiny parts
+        nominal = engine.abcd[index]
+        entries = [nominal[None, :, 0, 0], nominal[None, :, 0, 1], nominal[None, :, 1, 0], nominal[None, :, 1, 1]]
+        scaled = np.ones(size, dtype=bool)
+        if self.interpolate:
+            scaled = self._interpolate(engine, index, values, entries)
+        if scaled.any():
+            self._scale(engine, index, value, values, entries, scaled)
+        return entries
+
+
+    def _interpolate(self, engine, index, values, entries):
+        # blends all entries, returns the mask of the samples outside of the library range (still nominal)
+        part_index = self.part_index
+        same = np.flatnonzero((part_index.kinds == part_index.kinds[index]) & (part_index.shunt == part_index.shunt[index])
+                              & np.isfinite(part_index.values) & (part_index.values > 0))
+        order = same[np.argsort(part_index.values[same], kind='stable')]
+        library_values = part_index.values[order]
+        upper = np.searchsorted(library_values, values)
+        inside = (upper > 0) & (upper < len(order))
+        if not inside.any():
+            return ~inside
+        upper = np.where(inside, upper, 1)
+        (low, high) = (order[upper - 1], order[upper])
+        t = np.log(values / part_index.values[low]) / np.log(part_index.values[high] / part_index.values[low])
+        t = np.where(inside, t, 0)[:, None]
+        low = np.where(inside, low, index) # the nominal part for the samples outside
+        for (k, (row, column)) in enumerate([(0, 0), (0, 1), (1, 0), (1, 1)]):
+            entries[k] = (1 - t) * engine.abcd[low, :, row, column] + t * engine.abcd[high, :, row, column]
+        return ~inside
+
+
+    def _scale(self, engine, index, value, values, entries, mask):
+        # replaces the series impedance b (shunt admittance c) of the samples in mask
+        part_index = self.part_index
+        omega = 2 * np.pi * engine.frequency.f
+        nominal = engine.abcd[index]
+        values = values[:, None]
+        if part_index.shunt[index]:
+            admittance = nominal[:, 1, 0]
+            if part_index.kinds[index] == 'L':
+                admittance = admittance * (value / values)
+            else:
+                admittance = admittance + 1j * omega * (values - value)
+            entries[2] = np.where(mask[:, None], admittance, entries[2])
+        else:
+            impedance = nominal[:, 0, 1]
+            if part_index.kinds[index] == 'L':
+                impedance = impedance * (values / value)
+            else:
+                with np.errstate(divide='ignore'):
+                    impedance = 1 / (1 / impedance + 1j * omega * (values - value))
+            entries[1] = np.where(mask[:, None], impedance, entries[1])